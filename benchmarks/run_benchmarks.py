@@ -0,0 +1,305 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark harness for the ccores pipeline.
+
+Times twod.cwt2d, wav.wavelet.calc_coeffs, cores.dataset.read_img, applyWavelet, every constants.UTILS power filter
+and to_dataarray on synthetic cloud top temperature grids, for every constants.NAMES preset, grid size and cloud /
+core count. Reports wall time (min / median of repeated runs), peak RSS and peak traced allocations per stage and
+writes the results to a JSON file, which can be compared against the results of another commit.
+
+Each (preset, size, clouds, cores) case runs in a fresh process, so that peak RSS and caches don't leak between cases.
+
+EXAMPLES
+    # default matrix: all presets, 256 / 512 / 1024 pixel grids, 10 and 100 clouds with 3 cores each
+    python benchmarks/run_benchmarks.py --out bench_HEAD.json
+
+    # single preset up to full disk size
+    python benchmarks/run_benchmarks.py --presets METEOSAT5K_vera --sizes 256 1024 full --out bench.json
+
+    # compare two result files, exit status 1 if any stage got slower than 1.2x
+    python benchmarks/run_benchmarks.py --compare bench_old.json bench_HEAD.json --threshold 1.2
+"""
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+# benchmark the ccores package this script lives in
+_PACKAGE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(_PACKAGE))
+
+from ccores import constants, cores, twod
+
+
+FULL_DISK = 3712  # MSG SEVIRI full disk, pixels per side
+DEFAULT_SIZES = ['256', '512', '1024']
+DEFAULT_CLOUDS = [10, 100]
+DEFAULT_CORES = [3]
+
+
+
+def synthetic_tir(n, m, res, n_clouds, n_cores, seed=0):
+    """
+    Synthetic cloud top temperature image (deg C): warm background with n_clouds cold, roughly circular clouds of
+    20 - 300 km diameter, each with n_cores embedded convective cores (cold gaussian anomalies of 10 - 40 km).
+    :param n: number of rows
+    :param m: number of columns
+    :param res: pixel resolution in km
+    :param n_clouds: number of clouds
+    :param n_cores: number of cores per cloud
+    :param seed: random seed
+    :return: 2d array (n, m)
+    """
+    rng = np.random.default_rng(seed)
+    t = 20. + rng.normal(0, 1, (n, m))
+
+    for _ in range(n_clouds):
+        r = rng.uniform(10, 150) / res
+        cy, cx = rng.uniform(0, n), rng.uniform(0, m)
+        y0, y1 = int(max(cy - r, 0)), int(min(cy + r + 1, n))
+        x0, x1 = int(max(cx - r, 0)), int(min(cx + r + 1, m))
+        if (y1 <= y0) or (x1 <= x0):
+            continue
+        yy, xx = np.mgrid[y0:y1, x0:x1]
+        d2 = ((yy - cy) ** 2 + (xx - cx) ** 2) / r ** 2
+        cloud = np.where(d2 < 1, -45. - 15. * (1 - d2), np.inf)
+
+        for _ in range(n_cores):
+            cr = rng.uniform(5, 20) / res
+            ky, kx = cy + rng.uniform(-0.6, 0.6) * r, cx + rng.uniform(-0.6, 0.6) * r
+            cloud -= rng.uniform(10, 30) * np.exp(-((yy - ky) ** 2 + (xx - kx) ** 2) / (2 * cr ** 2)) * (d2 < 1)
+
+        window = t[y0:y1, x0:x1]
+        np.minimum(window, cloud, out=window)
+
+    return t
+
+
+
+def _reset_peak_rss():
+    """
+    Resets the peak resident set size of this process (Linux only).
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def _peak_rss_mb():
+    """
+    Peak resident set size of this process in MB, since the last _reset_peak_rss if resetting is supported.
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024.
+    except OSError:
+        pass
+    scale = 1024. ** 2 if sys.platform == 'darwin' else 1024.  # ru_maxrss: bytes on macOS, kB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+
+
+
+def _measure(func, repeat):
+    """
+    Runs func repeat times for wall time, then once more under tracemalloc for peak RSS and allocations.
+    Prints of the pipeline are silenced.
+    """
+    times = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        for _ in range(repeat):
+            t0 = time.perf_counter()
+            out = func()
+            times.append(time.perf_counter() - t0)
+
+        resettable = _reset_peak_rss()
+        tracemalloc.start()
+        func()
+        alloc_peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    return out, dict(time_min=min(times), time_median=statistics.median(times), times=times,
+                     peak_rss_mb=_peak_rss_mb(), peak_rss_since_stage=resettable,
+                     alloc_peak_mb=alloc_peak / 1024. ** 2)
+
+
+
+def run_case(case):
+    """
+    Benchmarks all stages of one (preset, size, clouds, cores) case.
+    :param case: dictionary with preset, size, clouds, cores, repeat, seed
+    :return: list of result dictionaries, one per stage
+    """
+    preset, size, repeat = case['preset'], case['size'], case['repeat']
+    n = FULL_DISK if size == 'full' else int(size)
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        obj = cores.dataset(preset, **case.get('dataset_kwargs', {}))
+    res = obj.res
+    t = synthetic_tir(n, n, res, case['clouds'], case['cores'], seed=case['seed'])
+    lon = np.arange(n) * res / 111.
+    lat = np.arange(n) * res / 111.
+    date = np.datetime64('2020-01-01T12:00')
+
+    stages = []
+
+    def record(stage, func, **extra):
+        out, result = _measure(func, repeat)
+        result.update(preset=preset, size=size, clouds=case['clouds'], cores=case['cores'], stage=stage, **extra)
+        stages.append(result)
+        return out
+
+    record('read_img', lambda: obj.read_img(t, lon, lat))
+
+    # wavelet input as prepared by applyWavelet
+    tir = obj.image.copy()
+    tir[tir > 0] = 0
+    tir = tir - np.mean(tir)
+    w = obj.wavelet
+
+    record('cwt2d', lambda: twod.cwt2d(tir, w.res, w.res, dj=w.scale_dist, s0=w.scale_start, J=w.scale_number,
+                                       rfft=True, backend=w.fft, pad=w.pad, pad_mode=w.pad_mode, dtype=w.dtype))
+    record('calc_coeffs', lambda: w.calc_coeffs(tir, ge_thresh=0, fill=0.01))
+    record('applyWavelet', lambda: obj.applyWavelet())
+
+    for wtype in constants.UTILS:
+        out = record('filter_' + wtype, lambda: obj.scaleWeighting(wtype=wtype))
+        power = out[0] if isinstance(out, tuple) else out
+        stages[-1]['n_cores'] = int(np.sum(power < 0)) if power is not None else 0
+
+    obj.scaleWeighting(wtype='sum')
+    record('to_dataarray', lambda: obj.to_dataarray(date=date))
+
+    return stages
+
+
+
+def run(presets, sizes, clouds, n_cores, repeat=3, seed=0, isolate=True, dataset_kwargs=None):
+    """
+    Runs the benchmark matrix.
+    :return: results dictionary with meta information and one entry per stage and case
+    """
+    cases = [dict(preset=p, size=s, clouds=c, cores=k, repeat=repeat, seed=seed, dataset_kwargs=dataset_kwargs or {})
+             for p in presets for s in sizes for c in clouds for k in n_cores]
+
+    results = []
+    for i, case in enumerate(cases):
+        print('[{}/{}] {preset} {size}px {clouds} clouds x {cores} cores'.format(i + 1, len(cases), **case))
+        if isolate:
+            with multiprocessing.get_context('spawn').Pool(1) as pool:
+                stages = pool.apply(run_case, (case,))
+        else:
+            stages = run_case(case)
+        for r in stages:
+            print('    {stage:<20} {time_min:9.4f} s  {peak_rss_mb:9.1f} MB RSS  {alloc_peak_mb:9.1f} MB alloc'.format(**r))
+        results.extend(stages)
+
+    return dict(meta=_meta(dict(presets=presets, sizes=sizes, clouds=clouds, cores=n_cores, repeat=repeat,
+                                seed=seed, isolate=isolate, dataset_kwargs=dataset_kwargs or {})),
+                results=results)
+
+
+
+def _meta(args):
+    """
+    Environment of a benchmark run.
+    """
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=_PACKAGE,
+                                         stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    import scipy
+    return dict(commit=commit, date=datetime.datetime.now().isoformat(), python=platform.python_version(),
+                numpy=np.__version__, scipy=scipy.__version__, platform=platform.platform(),
+                cpu_count=os.cpu_count(), args=args)
+
+
+
+def _key(r):
+    return (r['preset'], str(r['size']), r['clouds'], r['cores'], r['stage'])
+
+
+def compare(old, new, threshold=1.1):
+    """
+    Compares two result files stage by stage (min wall time and allocation peak ratios new / old).
+    :param old: path to the reference results
+    :param new: path to the new results
+    :param threshold: ratio above which a stage counts as regression
+    :return: number of regressions
+    """
+    with open(old) as f:
+        old = json.load(f)
+    with open(new) as f:
+        new = json.load(f)
+
+    print('old:', old['meta'].get('commit'), ' new:', new['meta'].get('commit'))
+    reference = {_key(r): r for r in old['results']}
+    regressions = 0
+    print('{:<20} {:>6} {:>6} {:>6} {:<20} {:>10} {:>10} {:>7} {:>7}'.format(
+        'preset', 'size', 'clouds', 'cores', 'stage', 'old [s]', 'new [s]', 'time', 'alloc'))
+    for r in new['results']:
+        o = reference.get(_key(r))
+        if o is None:
+            continue
+        t_ratio = r['time_min'] / o['time_min'] if o['time_min'] > 0 else np.nan
+        a_ratio = r['alloc_peak_mb'] / o['alloc_peak_mb'] if o['alloc_peak_mb'] > 0 else np.nan
+        flag = ''
+        if (t_ratio > threshold) or (a_ratio > threshold):
+            flag = '  <-- regression'
+            regressions += 1
+        print('{:<20} {:>6} {:>6} {:>6} {:<20} {:>10.4f} {:>10.4f} {:>6.2f}x {:>6.2f}x{}'.format(
+            r['preset'], r['size'], r['clouds'], r['cores'], r['stage'], o['time_min'], r['time_min'], t_ratio,
+            a_ratio, flag))
+    print(regressions, 'regressions (threshold {}x)'.format(threshold))
+    return regressions
+
+
+
+def main():
+    parser = argparse.ArgumentParser(description='ccores pipeline benchmarks')
+    parser.add_argument('--presets', nargs='+', default=list(constants.NAMES),
+                        help='constants.NAMES presets (default: all)')
+    parser.add_argument('--sizes', nargs='+', default=DEFAULT_SIZES,
+                        help="grid sizes in pixels per side, 'full' for full disk ({}px)".format(FULL_DISK))
+    parser.add_argument('--clouds', nargs='+', type=int, default=DEFAULT_CLOUDS, help='numbers of clouds')
+    parser.add_argument('--cores', nargs='+', type=int, default=DEFAULT_CORES, help='numbers of cores per cloud')
+    parser.add_argument('--repeat', type=int, default=3, help='timed runs per stage')
+    parser.add_argument('--seed', type=int, default=0, help='random seed of the synthetic images')
+    parser.add_argument('--dtype', default='float64', help="dataset working precision, 'float64' or 'float32'")
+    parser.add_argument('--fft-backend', default='numpy', help="dataset FFT backend, 'numpy', 'scipy' or 'pyfftw'")
+    parser.add_argument('--no-isolate', action='store_true', help='run all cases in this process')
+    parser.add_argument('--out', default=None, help='JSON output file')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='compare two JSON result files')
+    parser.add_argument('--threshold', type=float, default=1.1, help='regression threshold for --compare')
+    args = parser.parse_args()
+
+    if args.compare:
+        sys.exit(1 if compare(*args.compare, threshold=args.threshold) else 0)
+
+    results = run(args.presets, args.sizes, args.clouds, args.cores, repeat=args.repeat, seed=args.seed,
+                  isolate=not args.no_isolate, dataset_kwargs=dict(dtype=args.dtype, fft_backend=args.fft_backend))
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=1)
+        print('Saved ' + args.out)
+
+
+if __name__ == '__main__':
+    main()
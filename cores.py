@@ -1,14 +1,50 @@
-from ccores import constants, wav
+from ccores import constants, wav, twod, ioUtils, perfUtils
 import numpy as np
 from scipy.ndimage.measurements import label
 from scipy import ndimage
 import xarray as xr
 import os
+from concurrent.futures import ProcessPoolExecutor
+import threading
+
+# attributes set by read_img, i.e. the state of one prepared image
+_IMAGE_ATTRS = ['original', '_t_unpack', 'image', 'minPixel', 'area', 'invalid', 'lon', 'lat']
 
-class dataset(object):
 
-    def __init__(self, dataname):
+class dataset(object):
 
+    def __init__(self, dataname, fft_backend='numpy', fft_workers=None, fft_plan_cache=True, fft_wisdom=None,
+                 pad='pow2', pad_mode='constant', dtype='float64', tile=None, tile_halo=None, tile_workers=1,
+                 engine='fft', profiler=None):
+        """
+        Initialises the wavelet setup for one of the datasets defined in constants.NAMES.
+        :param dataname: dataset name, key of constants.NAMES
+        :param fft_backend: FFT implementation for the wavelet transform: 'numpy' (default), 'scipy' (multi-threaded
+                            scipy.fft) or 'pyfftw' (FFTW, if installed)
+        :param fft_workers: number of FFT threads for 'scipy' and 'pyfftw', -1 uses all cores (default: None, 1 thread)
+        :param fft_plan_cache: pyfftw only, reuse FFTW plans between calls (default: True)
+        :param fft_wisdom: pyfftw only, path to a FFTW wisdom file to load, see self.fft.save_wisdom (default: None)
+        :param pad: FFT padding policy: 'pow2' pads to the next power of two (default), 'fast' to the next 5-smooth
+                    length, e.g. 1100x1600 -> 1125x1600 instead of 2048x2048
+        :param pad_mode: fill of the FFT padding: 'constant' (zeros, default), 'reflect' or 'symmetric' (mirrored image,
+                         keeps edge effects small when the padding is narrow, recommended with pad='fast')
+        :param dtype: working precision of pre-processing, wavelet transform and power filters, 'float64' (default)
+                      or 'float32'. float32 halves memory and memory bandwidth, use it with fft_backend='scipy' or
+                      'pyfftw' for single precision FFTs. See README for the accuracy check against float64.
+        :param tile: optional tile size in pixels for a tiled wavelet transform of very large domains (see
+                     twod.cwt2d_tiled). Default None: full domain transform.
+        :param tile_halo: tile halo width in pixels. Default: 6x the largest wavelet scale, which matches the full
+                          domain transform to 1e-6 (relative) away from the image borders (more than tile_halo
+                          pixels). Closer to the borders, single pixels of the power filters can differ.
+        :param tile_workers: number of threads transforming tiles in parallel (default: 1)
+        :param engine: wavelet transform engine: 'fft' (default), 'direct' convolves the image with the truncated
+                       spatial wavelet, 'auto' picks the cheaper of both per scale (direct for small kernels on large
+                       FFT grids, see twod.use_direct). The direct engine matches the FFT transform to within 5e-5
+                       (relative to the largest coefficient of each scale) away from the image borders.
+        :param profiler: optional perfUtils.profiler recording time (and optionally peak memory) of the pipeline
+                         stages read_img, label, wavelet, fft_forward, fft_inverse, threshold, weighting and io.
+                         Default None: no instrumentation.
+        """
 
         if dataname in constants.NAMES:
             dic = constants.NAMES[dataname]
@@ -24,19 +60,47 @@ class dataset(object):
         self.Tcut = dic['Tcut']
         self.Twav = dic['Twav']
 
+        self.fft = twod.FFTBackend(fft_backend, workers=fft_workers, plan_cache=fft_plan_cache, wisdom=fft_wisdom)
+        if pad not in twod.PAD_POLICIES:
+            print('Padding policy not found. Choose one of ' + str(twod.PAD_POLICIES))
+            return
+        if pad_mode not in twod.PAD_MODES:
+            print('Padding mode not found. Choose one of ' + str(twod.PAD_MODES))
+            return
+        self.pad = pad
+        self.pad_mode = pad_mode
+        if np.dtype(dtype) not in [np.float32, np.float64]:
+            print('dtype not supported. Choose "float64" or "float32"')
+            return
+        self.dtype = np.dtype(dtype)
+        if engine not in twod.ENGINES:
+            print('Engine not found. Choose one of ' + str(twod.ENGINES))
+            return
 
-        obj = wav.wavelet(self.res, self.dist, self.nb, start=self.start)
-        self.scales = obj.scales
+        # setup needed to re-create this object, e.g. in worker processes of process_stack
+        self._setup = dict(fft_backend=fft_backend, fft_workers=fft_workers, fft_plan_cache=fft_plan_cache,
+                           fft_wisdom=fft_wisdom, pad=pad, pad_mode=pad_mode, dtype=str(self.dtype), tile=tile,
+                           tile_halo=tile_halo, tile_workers=tile_workers, engine=engine)
+
+        # wavelet setup, reused for every image processed with this object
+        self.wavelet = wav.wavelet(self.res, self.dist, self.nb, start=self.start, fft=self.fft, pad=self.pad,
+                                   pad_mode=self.pad_mode, dtype=self.dtype, tile=tile, halo=tile_halo,
+                                   tile_workers=tile_workers, engine=engine, profiler=profiler)
+        self.profiler = profiler
+        self._workspace = wav.workspace()  # reusable wavelet arrays of process_stack
+        self.scales = self.wavelet.scales
 
         print('Initialised wavelet with scales: ', self.scales)
 
 
 
-    def read_img(self, torig, lon, lat, edge_smoothing=False, dynamic_background=False, min_area = False):
+    def read_img(self, torig, lon, lat, edge_smoothing=False, dynamic_background=False, min_area = False, t_scale=None,
+                 t_offset=None, keep_original=True):
         """
         Filters clouds of set area threshold and prepares image for wavelet analysis via adjusting background temperature
         and smoothing cloud edges.
-        t: numpy array, cloud top temperature data
+        t: numpy array, cloud top temperature data. Can also be a lazily loaded or memory-mapped 2d array or
+           DataArray (see ioUtils.open_tir, ioUtils.open_raw), which is read once into a single working copy.
         lon: 1d numpy array, longitude or x
         lat: 1d numpy array, latitude or y
         edge_smoothing: optional cloud edge smoothing via gaussian filter - can help in case of excessive core
@@ -45,6 +109,10 @@ class dataset(object):
                             can help in case of excessive core identification at cloud edges (default: False)
         min_area: optional minimum area threshold for identified clouds. If false, minimum is defined by the minimum
                   core scale (default: False)
+        t_scale, t_offset: optional unpacking of packed data, applied to the working copy as t * t_scale + t_offset,
+                           e.g. t_scale=0.01 for temperatures stored as int16 in hundredths of degrees
+        keep_original: if False, no reference to the input data is kept (self.original is None) and to_dataarray
+                       writes no tir variable (default: True)
 
         :return: filtered cloud top temperatures with adjusted background temperature
         """
@@ -53,19 +121,86 @@ class dataset(object):
         if not np.allclose(londiff, np.zeros_like(londiff)+londiff[0]):
             print('Please provide regular grid coordinates.')
 
-        self.original = torig
-        t = torig.copy()
+        self.original = torig if keep_original else None
+        self._t_unpack = (t_scale, t_offset)
+        with perfUtils.stage(self.profiler, 'read_img', shape=np.shape(torig)) as record:
+            t = self._working_copy(torig)
+
+            t[t >= self.Tcut] = 0
+            t[t <= -150] = 0
+            t[np.isnan(t)] = 0
+            outt = t  # the working copy becomes the prepared image, no second copy
+            print('outmin', np.nanmin(outt), np.nanmax(outt))
+            with perfUtils.stage(self.profiler, 'label'):
+                labels, numL = label(outt)
+
+                # number of pixels per label (label 0 is the background), used as label -> size lookup table
+                n = np.bincount(labels.ravel())
+
+            pix_nb = self._min_pixels(min_area)
+
+            good = (n >= pix_nb)[labels]  # pixels of clouds (labels) reaching the minimum size
+
+            outt[~good] = 0
+            area_img = np.zeros_like(outt)
+            area_img[good] = n[labels[good]]  # number of pixels of the cloud a pixel belongs to #*self.res**2
+
+            #detect edge for optional edge smoothing
+            outt[outt >= self.Twav] = 150
+            grad = np.gradient(outt)
+            outt[outt == 150] = np.nan
+
+            invalid = np.isnan(outt)
+
+            # T difference between cloud edge and background
+            if dynamic_background:
+                tdiff = np.nanmax(outt) - np.nanmin(outt)
+                xmin = 0.5*tdiff
+            else:
+                xmin = 10
+
+            outt[invalid] = self.Twav - xmin
+
+            if edge_smoothing:
+                # cloud edges: strong T gradient along either axis
+                d = 2
+                edges = np.hypot(grad[0], grad[1]) > 80
+                # blend in the gaussian smoothed image within the (2d+1)x(2d+1) neighbourhood of edge pixels
+                edges = ndimage.binary_dilation(edges, structure=np.ones((2 * d + 1, 2 * d + 1), dtype=bool))
+                smooth = ndimage.gaussian_filter(outt, 3, mode='nearest', truncate=d / 3.)
+                outt[edges] = smooth[edges]
 
-        t[t >= self.Tcut] = 0
-        t[t <= -150] = 0
-        t[np.isnan(t)] = 0
-        outt = t.copy()
-        print('outmin', np.nanmin(outt), np.nanmax(outt))
-        labels, numL = label(outt)
 
-        u, inv = np.unique(labels, return_inverse=True)
-        n = np.bincount(inv)
+            self.image = outt
 
+            self.minPixel = pix_nb
+            self.area = area_img
+            self.invalid = invalid
+            self.lon = lon
+            self.lat = lat
+            record['nbytes'] = outt.nbytes
+
+
+
+    def _working_copy(self, torig):
+        """
+        Single working copy of input temperatures in working precision, unpacked as set in read_img.
+        """
+        t = np.array(torig, dtype=self.dtype)
+        t_scale, t_offset = getattr(self, '_t_unpack', (None, None))
+        if t_scale is not None:
+            t *= t_scale
+        if t_offset is not None:
+            t += t_offset
+        return t
+
+
+
+    def _min_pixels(self, min_area=False):
+        """
+        Minimum number of pixels of clouds kept by read_img.
+        :param min_area: optional minimum area threshold for identified clouds, see read_img
+        """
         # some approximate minimum cloud scales: 3 pixels across in any direction for minimum wavelet
         min_diameter_cloud = 3 * self.res
 
@@ -76,67 +211,37 @@ class dataset(object):
             mincloud = (np.pi * min_diameter_cloud**2)
 
         # min number of pixels in circular cloud
-        pix_nb = mincloud / self.res**2  # ~ 500km2 cloud = 20 pixel at 5km res
-
-        badinds = u[(n < pix_nb)]
-        goodinds = u[n >= pix_nb]
-
-        area_img = np.zeros_like(outt)
-        for bi in badinds:
-            inds = np.where(labels == bi)
-            outt[inds] = 0
-        for bi in goodinds:
-            inds = np.where(labels==bi)
-            area_img[inds]= int(len(inds[0]))#*self.res**2
-
-        #detect edge for optional edge smoothing
-        outt[outt >= self.Twav] = 150
-        grad = np.gradient(outt)
-        outt[outt == 150] = np.nan
-
-        invalid = np.isnan(outt)
-
-        # T difference between cloud edge and background
-        if dynamic_background:
-            tdiff = np.nanmax(outt) - np.nanmin(outt)
-            xmin = 0.5*tdiff
-        else:
-            xmin = 10
+        return mincloud / self.res**2  # ~ 500km2 cloud = 20 pixel at 5km res
 
-        outt[invalid] = self.Twav - xmin
 
-        if edge_smoothing:
-            nok = np.where(abs(grad[0]) > 80)
-            d = 2
-            i = nok[0]
-            j = nok[1]
 
-            for ii, jj in zip(i, j):
-                kern = outt[ii - d:ii + d + 1, jj - d:jj + d + 1]
-                outt[ii - d:ii + d + 1, jj - d:jj + d + 1] = ndimage.gaussian_filter(kern, 3, mode='nearest')
-
-
-        self.image = outt
-
-        self.minPixel = pix_nb
-        self.area = area_img
-        self.invalid = invalid
-        self.lon = lon
-        self.lat = lat
-
-
-
-    def applyWavelet(self, ge_thresh=0, fill=0.01, le_thresh=None, normed='scale'):
+    def applyWavelet(self, ge_thresh=0, fill=0.01, le_thresh=None, normed='scale', stream=False, workspace=None,
+                     products=('coeffs', 'power')):
         """
         Applies the wavelet functions and handles wavelet coefficient filtering.
         :param ge_thresh: greater-equal threshold for coefficient filtering.
         :param fill: fill value for filtering thresholds
         :param le_thresh: less-equal threshold for coefficient filtering.
+        :param stream: if True, wavelet coefficients and power are not stored as (scales, y, x) cubes. Instead, the
+                       power is computed scale by scale whenever it is needed (see iter_power), i.e. by the
+                       power filters in scaleWeighting, which only keep running 2d reductions. Peak memory then
+                       scales with the image size instead of image size times number of scales. self.power and
+                       self.coeffs are set to None.
+        :param workspace: optional wav.workspace: self.coeffs and self.power are written into its reusable arrays
+                          instead of new ones, so repeated calls on same-sized images allocate no new cubes. They are
+                          overwritten by the next call with the same workspace.
+        :param products: wavelet products computed and kept (see wav.PRODUCTS): 'coeffs' (self.coeffs), 'raw_power'
+                         (self.raw_power, squared coefficients after thresholding, not normalised), 'power'
+                         (self.power, normalised power) and 'power_sum' (self.power_sum, 2d normalised power summed
+                         over scales). Products not requested are None and their cubes are never allocated, e.g.
+                         ('power',) keeps a single cube instead of two. Power filters that need the per-scale power
+                         recompute it scale by scale (as with stream=True) if 'power' is not kept, filters summing
+                         all scales ('sum', 'nflics') use power_sum directly. Default: ('coeffs', 'power')
         :return: Wavelet coefficient and wavelet power attributes of the wavelet object.
         """
 
         try:
-            tir = self.image.copy()
+            tir = self._wavelet_input()
         except NameError:
             print('No image found to apply wavelet. Please read in an image first.')
             return
@@ -144,26 +249,83 @@ class dataset(object):
 
         print('Wavelet coefficients and power normed by:', normed, 'Possible tags: "scale", "stddev"')
 
+        obj = self.wavelet
+        self._power_std = {}  # per-scale power std of the power filters, see powerUtils._power_std
+
+        kwargs = dict(ge_thresh=ge_thresh, fill=fill, le_thresh=le_thresh, normed=normed)
+        self.raw_power = None
+        self.power_sum = None
+        if stream:
+            self.power = None
+            self.coeffs = None
+            self._stream = (obj, tir, kwargs)
+            return
+
+        with perfUtils.stage(self.profiler, 'wavelet', shape=tir.shape, normed=normed, products=tuple(products)):
+            out = obj.calc_products(tir, products=products, workspace=workspace, **kwargs)
+
+        self.power = out.get('power')
+        self.coeffs = out.get('coeffs')
+        self.raw_power = out.get('raw_power')
+        self.power_sum = out.get('power_sum')
+        # without the power cube, filters get the power scale by scale from the streamed transform
+        self._stream = None if self.power is not None else (obj, tir, kwargs)
+
+        del tir
+
+
 
+    def _wavelet_input(self):
+        """
+        Wavelet input of the current image: cloud temperatures <= 0, mean removed.
+        """
+        tir = self.image.copy()
         tir[tir > 0] = 0
-        tir = tir - np.mean(tir)
+        return tir - np.mean(tir)
+
 
-        obj = wav.wavelet(self.res, self.dist, self.nb, start=self.start)
 
-        coeffsTIR, powerTIR = obj.calc_coeffs(tir, ge_thresh=ge_thresh, fill=fill, le_thresh=le_thresh, normed=normed)
+    def _apply_batch(self, tirs, ge_thresh=0, fill=0.01, le_thresh=None, normed='scale', workspace=None,
+                     products=('coeffs', 'power')):
+        """
+        applyWavelet for a stack of wavelet inputs (see _wavelet_input). The default products (coefficients and
+        power) are transformed in one batch, other products image by image with wav.calc_products.
+        :return: list of product dictionaries (see wav.calc_products), one per image
+        """
+        print('Wavelet coefficients and power normed by:', normed, 'Possible tags: "scale", "stddev"')
+        kwargs = dict(ge_thresh=ge_thresh, fill=fill, le_thresh=le_thresh, normed=normed)
+        with perfUtils.stage(self.profiler, 'wavelet', shape=tirs.shape, normed=normed, products=tuple(products)):
+            if set(products) == {'coeffs', 'power'}:
+                coeffs, power = self.wavelet.calc_coeffs_batch(tirs, workspace=workspace, **kwargs)
+                return [dict(coeffs=coeffs[ids], power=power[ids]) for ids in range(len(tirs))]
+            # the products of all images are kept until the batch is weighted: no shared workspace buffers
+            return [self.wavelet.calc_products(tir, products=products, **kwargs) for tir in tirs]
+
 
-        self.power = powerTIR
-        self.coeffs = coeffsTIR
 
-        del tir
+    def iter_power(self):
+        """
+        Yields the wavelet power of one scale at a time (2d arrays, smallest to largest scale). Taken from self.power
+        if the wavelet was applied with stream=False, otherwise computed on the fly.
+        """
+        if self.power is not None:
+            for ids in range(self.power.shape[0]):
+                yield self.power[ids, :, :]
+        else:
+            obj, tir, kwargs = self._stream
+            for coeffs, power in obj.iter_power(tir, **kwargs):
+                yield power
 
 
 
-    def scaleWeighting(self, wtype='sum', data_tag='MSG'):
+    def scaleWeighting(self, wtype='sum', data_tag='MSG', core_table=False):
         """
          Accesses the wavelet power filtering utility functions.
         :param wtype: Defines method for wavelet power weighting and core identification
         :param data_tag: Identifies input data if needed for wtype
+        :param core_table: if True, the filter also extracts a columnar core table (dictionary of 1d arrays with
+                           powerUtils.CORE_TABLE_COLUMNS: label, y, x, lat, lon, area, tmin, power_max, scale), stored
+                           as self.core_table (None if the filter found no power)
         :return: power from weighted scales
         """
 
@@ -174,7 +336,17 @@ class dataset(object):
         self.data_tag = data_tag
 
         Sweighting = constants.UTILS[wtype]
-        self.scale_weighted = Sweighting(self)
+        self.core_table = None
+        with perfUtils.stage(self.profiler, 'weighting', wtype=wtype):
+            if core_table:
+                self.scale_weighted = Sweighting(self, table=True)
+                if isinstance(self.scale_weighted, tuple):
+                    self.core_table = self.scale_weighted[-1]
+                    self.scale_weighted = self.scale_weighted[:-1]
+                    if len(self.scale_weighted) == 1:
+                        self.scale_weighted = self.scale_weighted[0]
+            else:
+                self.scale_weighted = Sweighting(self)
         if isinstance(self.scale_weighted, tuple):
             self.max_pos = self.scale_weighted[1]
             self.scale_weighted = self.scale_weighted[0]
@@ -183,7 +355,7 @@ class dataset(object):
             return self.scale_weighted
 
 
-    def to_dataarray(self, filepath=None, date=None, CLOBBER=False, names=None, scale_factor=False):
+    def to_dataarray(self, filepath=None, date=None, CLOBBER=False, names=None, scale_factor=False, writer=None):
         """
         Optional data saving function. Saves wavelet power and storm-filtered tir to netCDF files.
         :param filepath: outpath for save file
@@ -191,12 +363,13 @@ class dataset(object):
         :param CLOBBER: if True, overwrites existing file
         :param names: [str, str] format, gives custom names to power and thermal infrared (tir) data arrays.
                       If False: ['power', 'tir']
+        :param writer: optional ioUtils.writer, appends the dataset as new time slot to its Zarr store or NetCDF
+                       file (requires date) instead of writing a file per image
         :return: saves netcdf of xarray dataset with convective core power and original tir data
         """
 
-        new_savet = self.original.copy()
-        isnan = np.isnan(new_savet)
-        new_savet[isnan] = 0
+        if (date is not None) and (np.ndim(date) == 0):
+            date = [date]
 
         if scale_factor:
             sfactor=100
@@ -204,11 +377,21 @@ class dataset(object):
         else:
             sfactor=1
             dtype=np.int8
-        try:
-            new_savet = (np.round(new_savet, 2) * sfactor).astype(dtype)
-        except TypeError:
-            print('TIR data is None, DataArray conversion failed. Return')
-            return
+
+        if self.original is not None:
+            if self._t_unpack == (None, None):
+                new_savet = np.array(self.original)
+            else:
+                new_savet = self._working_copy(self.original)
+            isnan = np.isnan(new_savet)
+            new_savet[isnan] = 0
+            try:
+                new_savet = (np.round(new_savet, 2) * sfactor).astype(dtype)
+            except TypeError:
+                print('TIR data is None, DataArray conversion failed. Return')
+                return
+        else:
+            new_savet = None  # read_img(keep_original=False): no tir output
         try:
             new_power = (np.round(self.scale_weighted.copy(), 0)).astype(np.int16)
 
@@ -235,7 +418,7 @@ class dataset(object):
 
 
 
-        if date:
+        if date is not None:
             if new_power.ndim > 2:
 
                 try:
@@ -255,8 +438,9 @@ class dataset(object):
                     return
 
 
-            tir_da = xr.DataArray(new_savet[np.newaxis, :], coords={'time': date, 'lat': latitudes, 'lon': longitudes},  # 'time': date,
-                               dims=['time', 'lat', 'lon'])
+            if new_savet is not None:
+                tir_da = xr.DataArray(new_savet[np.newaxis, :], coords={'time': date, 'lat': latitudes, 'lon': longitudes},  # 'time': date,
+                                   dims=['time', 'lat', 'lon'])
 
         else:
 
@@ -277,8 +461,9 @@ class dataset(object):
                                         dims=['lat', 'lon'])
 
 
-            tir_da = xr.DataArray(new_savet, coords={'lat': latitudes, 'lon': longitudes},
-                                  dims=['lat', 'lon'])
+            if new_savet is not None:
+                tir_da = xr.DataArray(new_savet, coords={'lat': latitudes, 'lon': longitudes},
+                                      dims=['lat', 'lon'])
         if names is not None:
             power = names[0]
             tir = names[1]
@@ -287,42 +472,650 @@ class dataset(object):
             tir = 'tir'
 
         ds[power] = power_da
-        ds[tir] = tir_da
+        if new_savet is not None:
+            ds[tir] = tir_da
 
-        ds.attrs['radii'] = (np.floor(self.scales / 2. / float(self.res))).astype(np.uint8)
-        ds.attrs['scales_rounded'] = np.round(self.scales).astype(np.uint8)
-        ds.attrs['scales_original'] = self.scales
-        ds.attrs['cutout_T'] = self.Tcut
-        ds.attrs['cutout_minPixelNb'] = self.minPixel
-        ds.attrs['scaling_factor'] = sfactor
-        ds.attrs['assumed_resolution'] = self.res
+        ds.attrs.update(self._attrs(self.image.shape, sfactor, self.minPixel))
 
-        if filepath:
+        if writer is not None:
+            with perfUtils.stage(self.profiler, 'io', nbytes=ds.nbytes, target=writer.filepath):
+                writer.append(ds)
+
+        elif filepath:
+            with perfUtils.stage(self.profiler, 'io', nbytes=ds.nbytes, target=filepath):
+                _save_netcdf(ds, filepath, CLOBBER=CLOBBER)
 
-            if CLOBBER:
-                if os.path.isfile(filepath):
-                    os.remove(filepath)
-            comp = dict(zlib=True, complevel=5)
-            enc = {var: comp for var in ds.data_vars}
+        else:
 
-            ds.to_netcdf(path=filepath, mode='w', encoding=enc, format='NETCDF4')
-            print('Saved ' + filepath)
+            return ds
+
+
+
+    def _attrs(self, shape, sfactor, minPixel):
+        """
+        Dataset attributes describing the wavelet setup for output datasets.
+        :param shape: image shape
+        :param sfactor: tir scaling factor
+        :param minPixel: minimum cloud pixel number
+        """
+        attrs = {}
+        attrs['radii'] = (np.floor(self.scales / 2. / float(self.res))).astype(np.uint8)
+        attrs['scales_rounded'] = np.round(self.scales).astype(np.uint8)
+        attrs['scales_original'] = self.scales
+        attrs['cutout_T'] = self.Tcut
+        attrs['cutout_minPixelNb'] = minPixel
+        attrs['scaling_factor'] = sfactor
+        attrs['assumed_resolution'] = self.res
+        attrs['fft_padding'] = self.pad
+        attrs['fft_pad_mode'] = self.pad_mode
+        attrs['fft_shape'] = np.array(self.wavelet.fft_shape(shape))
+        if self.wavelet.tile:
+            attrs['tile_size'] = self.wavelet.tile
+            attrs['tile_halo'] = twod.tile_window(shape, self.wavelet.norm_scales, self.res, self.res,
+                                                  self.wavelet.tile, halo=self.wavelet.halo)[0]
+        return attrs
+
+
+
+    def process_lazy(self, data, wtype='sum', data_tag='MSG', preprocess=None, read_kwargs=None, wavelet_kwargs=None,
+                     names=None, scale_factor=False):
+        """
+        Lazy version of process_stack for (dask-backed) xarray time stacks: returns a lazy dataset of power and tir as
+        written by to_dataarray. Each block of time slots is processed with xr.apply_ufunc when the result is computed,
+        e.g. by ds.to_netcdf or ds.to_zarr, so only a few time slots are held in memory at once. Works with the dask
+        threaded and (local) distributed schedulers; every process/thread builds its own wavelet setup once.
+        :param data: xarray.DataArray with (time, lat, lon) dimensions, ideally chunked along time only, e.g.
+                     xr.open_dataarray(files, chunks={'time': 1}). lat and lon are rechunked to single chunks.
+        :param wtype: power weighting method for scaleWeighting (UTILS in constants.py). Needs to return a 2d power
+                      image, i.e. 'ind' is not supported.
+        :param data_tag: data_tag for scaleWeighting
+        :param preprocess: optional function applied to the DataArray before processing, e.g. for unit conversion:
+                           lambda da: da / 100
+        :param read_kwargs: dictionary of keyword arguments for read_img. t_scale / t_offset unpack tir as in read_img,
+                            keep_original=False drops tir from the output as in to_dataarray.
+        :param wavelet_kwargs: dictionary of keyword arguments for applyWavelet
+        :param names: [str, str] format, custom names for power and tir, default ['power', 'tir']
+        :param scale_factor: tir scaling as in to_dataarray
+        :return: lazy xarray dataset with power and tir (time, lat, lon). Unlike process_stack, which skips time slots
+                 without valid power (scaleWeighting returns None, e.g. no clouds), the lazy output keeps the time
+                 axis of data: such slots have zero power.
+        """
+
+        if wtype == 'ind':
+            print('Method type "ind" returns 3 power images per time slot and is not supported. Return')
+            return
+
+        if preprocess is not None:
+            data = preprocess(data)
+        if data.chunks is not None:
+            data = data.chunk({'lat': -1, 'lon': -1})
+
+        run_kwargs = dict(wtype=wtype, data_tag=data_tag, read_kwargs=read_kwargs or {},
+                          wavelet_kwargs=wavelet_kwargs or {})
+
+        power_da = xr.apply_ufunc(_lazy_block, data, input_core_dims=[['lat', 'lon']],
+                                  output_core_dims=[['lat', 'lon']], dask='parallelized', output_dtypes=[np.int16],
+                                  kwargs=dict(lon=data['lon'].values, lat=data['lat'].values, dataname=self.name,
+                                              setup=self._setup, run_kwargs=run_kwargs))
+
+        if scale_factor:
+            sfactor = 100
+            dtype = np.int16
+        else:
+            sfactor = 1
+            dtype = np.int8
+        read_kwargs = run_kwargs['read_kwargs']
+        t_scale, t_offset = read_kwargs.get('t_scale'), read_kwargs.get('t_offset')
+        if (t_scale is not None) or (t_offset is not None):
+            data = data.astype(self.dtype)  # unpacked in working precision, as read_img / to_dataarray
+            if t_scale is not None:
+                data = data * t_scale
+            if t_offset is not None:
+                data = data + t_offset
+        tir_da = (data.fillna(0).round(2) * sfactor).astype(dtype)
 
+        if names is not None:
+            power = names[0]
+            tir = names[1]
         else:
+            power = 'power'
+            tir = 'tir'
+
+        ds = xr.Dataset()
+        ds[power] = power_da
+        if read_kwargs.get('keep_original', True):
+            ds[tir] = tir_da
+        ds.attrs.update(self._attrs((data.sizes['lat'], data.sizes['lon']), sfactor,
+                                    self._min_pixels(read_kwargs.get('min_area', False))))
+
+        return ds
+
+
+
+    def process_stack(self, data, wtype='sum', data_tag='MSG', filepath=None, CLOBBER=False, varname=None,
+                      preprocess=None, read_kwargs=None, wavelet_kwargs=None, save_kwargs=None, n_workers=1,
+                      chunksize=1, writer=None, batch_size=1, tracker=None):
+        """
+        Batch driver for a time series of images on the same grid. Runs read_img -> applyWavelet -> scaleWeighting ->
+        to_dataarray for every time slot, reusing the wavelet setup (and the cached wavelet filter bank) of this object,
+        and concatenates the results along time.
+        :param data: xarray.DataArray with (time, lat, lon) dimensions, or a list of netCDF file paths that each hold
+                     one or more time slots on lat/lon coordinates. Each file is opened once per process and closed
+                     once its time slots are read.
+        :param wtype: power weighting method for scaleWeighting (UTILS in constants.py)
+        :param data_tag: data_tag for scaleWeighting
+        :param filepath: if given, the time-concatenated dataset is saved to this netCDF file
+        :param CLOBBER: if True, overwrites existing file
+        :param varname: variable to read from netCDF files. If None, the first data variable is used.
+        :param preprocess: optional function applied to each time slot DataArray before processing, e.g. for unit
+                           conversion: lambda da: da / 100. Must be a picklable (module level) function if
+                           n_workers > 1 and processes are not forked.
+        :param read_kwargs: dictionary of keyword arguments for read_img
+        :param wavelet_kwargs: dictionary of keyword arguments for applyWavelet
+        :param save_kwargs: dictionary of keyword arguments for to_dataarray (names, scale_factor)
+        :param n_workers: number of worker processes. Time slots are independent and are spread over a process pool
+                          if n_workers > 1. The wavelet setup is sent to each worker once, workers read file input
+                          themselves and return the compact (int8/int16) to_dataarray output of each slot. Output
+                          order always follows input order. Consider fft_workers=1 to avoid oversubscription.
+        :param chunksize: number of time slots (batches if batch_size > 1) sent to a worker per task (n_workers > 1)
+        :param writer: optional ioUtils.writer. Each time slot is appended to its Zarr store or NetCDF file as soon as
+                       it is processed (in input order) instead of concatenating all slots in memory
+        :param batch_size: number of time slots whose wavelet transforms are computed together (twod.cwt2d_batch):
+                           one forward FFT for the batch and one inverse FFT per scale, so that multi-threaded FFT
+                           backends (fft_workers > 1) can spread the batch over their threads. With single-threaded
+                           FFTs, batch_size=1 (default) is usually faster, as the slots of a batch no longer fit into
+                           the CPU caches. Memory grows with batch_size x the wavelet cubes of a slot. Results are
+                           identical to batch_size=1. Not used with wavelet_kwargs stream, where slots are
+                           transformed one by one. With wavelet_kwargs products other than ('coeffs', 'power'), the
+                           products of a batch are computed image by image. A wavelet_kwargs workspace holds the
+                           cubes of the whole batch.
+        :param tracker: optional trackUtils.tracker. Cores of each time slot (core table and filtered power of
+                        scaleWeighting) are linked to the cores of the previous slot as the slots are processed, see
+                        tracker.table() and tracker.summary() for the tracks. Requires time coordinates. With
+                        n_workers > 1, workers return the core table and core mask of each slot with its output and
+                        the slots are tracked in the main process, in input order.
+        :return: time-concatenated xarray dataset (None if saved to filepath or writer)
+        """
+
+        run_kwargs = dict(wtype=wtype, data_tag=data_tag, preprocess=preprocess, read_kwargs=read_kwargs or {},
+                          wavelet_kwargs=wavelet_kwargs or {}, save_kwargs=save_kwargs or {},
+                          track=tracker is not None)
+
+        refs = _slot_refs(data, varname=varname)
+
+        try:
+            if batch_size > 1:
+                batches = [refs[i:i + batch_size] for i in range(0, len(refs), batch_size)]
+                if n_workers > 1:
+                    with ProcessPoolExecutor(max_workers=n_workers, initializer=_init_worker,
+                                             initargs=(self.name, self._setup, run_kwargs)) as pool:
+                        out = _collect(_chain(pool.map(_run_worker_batch, batches, chunksize=chunksize)), writer,
+                                       tracker)
+                else:
+                    out = _collect(_chain(self._process_batch(_load_slots(batch), **run_kwargs)
+                                          for batch in batches), writer, tracker)
+            elif n_workers > 1:
+                with ProcessPoolExecutor(max_workers=n_workers, initializer=_init_worker,
+                                         initargs=(self.name, self._setup, run_kwargs)) as pool:
+                    out = _collect(pool.map(_run_worker, refs, chunksize=chunksize), writer, tracker)
+            else:
+                out = _collect((self._process_slot(_load_slot(ref), **run_kwargs) for ref in refs), writer, tracker)
+        finally:
+            _close_files()
 
+        if writer is not None:
+            return
+        out = [ds for ds in out if ds is not None]
+        if len(out) == 0:
+            print('No time slots processed. Return')
+            return
+
+        ds = xr.concat(out, dim='time') if 'time' in out[0].dims else out[0]
+
+        if filepath:
+            _save_netcdf(ds, filepath, CLOBBER=CLOBBER)
+        else:
             return ds
 
 
 
+    def _process_slot(self, da, wtype='sum', data_tag='MSG', preprocess=None, read_kwargs=None, wavelet_kwargs=None,
+                      save_kwargs=None, track=False):
+        """
+        Processing chain for a single time slot DataArray, see process_stack.
+        :return: to_dataarray output, None if the slot could not be processed. With track, (output, cores) with the
+                 cores of the slot for the tracker, see _slot_cores.
+        """
+        if preprocess is not None:
+            da = preprocess(da)
+        date = da['time'].values if 'time' in da.coords else None
+        print('Processing time slot', date)
+        if self.profiler is not None:
+            self.profiler.tags['slot'] = str(date)
+
+        self.read_img(da.variable, da['lon'].values, da['lat'].values, **read_kwargs)
+        # the wavelet cubes of a slot are only needed until its output is written: reuse them for the next slot
+        self.applyWavelet(**dict(dict(workspace=self._workspace), **wavelet_kwargs))
+        self.scaleWeighting(wtype=wtype, data_tag=data_tag, core_table=track)
+        ds = self.to_dataarray(date=date, **save_kwargs)
+        if ds is None:
+            print('Time slot', date, 'could not be processed, skipped.')
+        if track:
+            return ds, self._slot_cores(date)
+        return ds
+
+
+
+    def _process_batch(self, das, wtype='sum', data_tag='MSG', preprocess=None, read_kwargs=None,
+                       wavelet_kwargs=None, save_kwargs=None, track=False):
+        """
+        Processing chain for a batch of time slot DataArrays on the same grid, see process_stack(batch_size=...):
+        read_img per slot, one batched wavelet transform, then scaleWeighting and to_dataarray per slot.
+        :return: list of to_dataarray outputs (None for slots that could not be processed), of (output, cores) with
+                 track, see _process_slot
+        """
+        run_kwargs = dict(wtype=wtype, data_tag=data_tag, preprocess=preprocess, read_kwargs=read_kwargs,
+                          wavelet_kwargs=wavelet_kwargs, save_kwargs=save_kwargs)
+        if preprocess is not None:
+            das = [preprocess(da) for da in das]
+        if ((len(das) < 2) or wavelet_kwargs.get('stream', False) or
+                (len(set(da.shape for da in das)) > 1)):
+            return [self._process_slot(da, track=track, **dict(run_kwargs, preprocess=None)) for da in das]
+
+        slots = []
+        for da in das:
+            date = da['time'].values if 'time' in da.coords else None
+            print('Processing time slot', date)
+            if self.profiler is not None:
+                self.profiler.tags['slot'] = str(date)
+            self.read_img(da.variable, da['lon'].values, da['lat'].values, **read_kwargs)
+            slots.append((date, {key: getattr(self, key) for key in _IMAGE_ATTRS}, self._wavelet_input()))
+
+        wavelet_kwargs = dict(wavelet_kwargs)
+        wavelet_kwargs.pop('stream', None)
+        products = self._apply_batch(np.stack([tir for date, state, tir in slots]), **wavelet_kwargs)
+        stream_kwargs = {key: val for key, val in wavelet_kwargs.items() if key not in ['workspace', 'products']}
+        stream_kwargs = dict(dict(ge_thresh=0, fill=0.01, le_thresh=None, normed='scale'), **stream_kwargs)
+
+        out = []
+        for ids, (date, state, tir) in enumerate(slots):
+            if self.profiler is not None:
+                self.profiler.tags['slot'] = str(date)
+            self.__dict__.update(state)
+            self.power = products[ids].get('power')
+            self.coeffs = products[ids].get('coeffs')
+            self.raw_power = products[ids].get('raw_power')
+            self.power_sum = products[ids].get('power_sum')
+            # as in applyWavelet: without the power cube, filters get the power scale by scale
+            self._stream = None if self.power is not None else (self.wavelet, tir, stream_kwargs)
+            self._power_std = {}
+            self.scaleWeighting(wtype=wtype, data_tag=data_tag, core_table=track)
+            ds = self.to_dataarray(date=date, **save_kwargs)
+            if ds is None:
+                print('Time slot', date, 'could not be processed, skipped.')
+            out.append((ds, self._slot_cores(date)) if track else ds)
+        return out
+
+
+
+    def _slot_cores(self, date):
+        """
+        Cores of the current time slot for the tracker of process_stack: (date, core table, core mask), the arguments
+        of tracker.update. The core mask (non-zero filtered power, boolean) is small enough to be returned from
+        worker processes. None without time coordinate.
+        """
+        if date is None:
+            print('Time slot without time coordinate, cores not tracked.')
+            return
+        mask = None
+        if self.scale_weighted is not None:
+            mask = np.asarray(self.scale_weighted) != 0
+        return date, self.core_table, mask
+
+
+
+    def changed(self, torig, tol=1):
+        """
+        Mask of cloudy pixels whose cloud top temperature changed since the image last read with read_img, e.g. as
+        region of interest for update_roi.
+        :param torig: new cloud top temperature image on the same grid
+        :param tol: temperature change threshold (default: 1)
+        :return: 2d boolean array
+        """
+        if self.original is None:
+            print('No original image kept (read_img keep_original=False), cannot detect changes. Return')
+            return
+        new = self._working_copy(torig)
+        old = self._working_copy(self.original)
+        cloudy = (new < self.Tcut) | (old < self.Tcut)
+        return cloudy & ((np.abs(new - old) > tol) | (np.isnan(new) != np.isnan(old)))
+
+
+
+    def update_roi(self, torig, lon, lat, roi, wtype='sum', data_tag='MSG', halo=None, read_kwargs=None,
+                   wavelet_kwargs=None):
+        """
+        Incremental update of a previous read_img -> applyWavelet -> scaleWeighting run with a new image on the same
+        grid, e.g. for nowcasting updates of a region. Only the clouds touching a region of interest (in the new or
+        in the previous image) plus a halo are processed, as a sub-domain, and the results for the ROI and its clouds
+        are merged into scale_weighted, image, area and invalid (and the power and coefficient cubes, if not streamed)
+        of the previous run. Everything outside keeps the previous results.
+        The cost then scales with the size of the ROI instead of the full scene.
+        Note: as for the tiles of twod.cwt2d_tiled, the default halo of twod.HALO_WIDTH times the largest wavelet scale
+        keeps the wavelet power of the updated clouds within ~1e-6 of a full scene run, unless they are closer than
+        the halo to the image borders, where the padding of the sub-domain differs from the full scene. Smaller halos
+        (e.g. one maximum-scale radius) let the sub-domain borders change the power of the updated clouds and can
+        lose or shift cores. Scene dependent statistics of the power filters (e.g. the 25th power percentile, or the
+        standard deviation normalisation of 'dominant' and 'individual') and of read_img (dynamic_background) are
+        taken from the sub-domain, so the merged cores can still differ slightly from a full scene run. Full scene
+        runs at regular intervals are recommended.
+        :param torig: new cloud top temperature image, same grid as the previous run
+        :param lon: 1d numpy array, longitude or x
+        :param lat: 1d numpy array, latitude or y
+        :param roi: 2d boolean mask on the image grid (see changed), or bounding box (lon_min, lon_max, lat_min,
+                    lat_max) in coordinates of lon/lat
+        :param wtype: power weighting method for scaleWeighting (UTILS in constants.py)
+        :param data_tag: data_tag for scaleWeighting
+        :param halo: halo width around the updated region in pixels. Default: twod.HALO_WIDTH times the largest
+                     wavelet scale
+        :param read_kwargs: dictionary of keyword arguments for read_img
+        :param wavelet_kwargs: dictionary of keyword arguments for applyWavelet
+        :return: merged scale_weighted. self.updated holds the mask of updated pixels.
+        """
+        try:
+            prev = dict(scale_weighted=self.scale_weighted, image=self.image, area=self.area, invalid=self.invalid,
+                        power=self.power, coeffs=self.coeffs, raw_power=getattr(self, 'raw_power', None),
+                        power_sum=getattr(self, 'power_sum', None), max_pos=getattr(self, 'max_pos', None))
+        except AttributeError:
+            print('No previous results to update. Please run read_img, applyWavelet and scaleWeighting first.')
+            return
+
+        if wtype not in constants.UTILS:
+            print('Method type not found. Choose one of existing power weighting methods (UTILS in constants.py) or add a new one.')
+            return
+
+        torig = np.asarray(torig)
+        if torig.shape != self.image.shape:
+            print('Image shape differs from the previous run, ROI update not possible. Return')
+            return
+
+        if np.ndim(roi) == 1:
+            lon_min, lon_max, lat_min, lat_max = roi
+            latitudes, longitudes = _axes(lat, lon)
+            roi = ((latitudes >= lat_min) & (latitudes <= lat_max))[:, np.newaxis] & \
+                  ((longitudes >= lon_min) & (longitudes <= lon_max))[np.newaxis, :]
+        roi = np.asarray(roi, dtype=bool)
+
+        # ROI plus all clouds touching it, in the new and in the previous image
+        region = roi | _touching(self._cloud_labels(torig), roi)
+        if self.original is not None:
+            region |= _touching(self._cloud_labels(self.original), roi)
+        if not region.any():
+            print('Nothing to update in ROI')
+            self.updated = region
+            return self.scale_weighted
+
+        if halo is None:
+            halo = int(np.ceil(twod.HALO_WIDTH * self.wavelet.norm_scales[-1] / self.res))
+        rows = np.flatnonzero(region.any(axis=1))
+        cols = np.flatnonzero(region.any(axis=0))
+        ys = slice(max(rows[0] - halo, 0), min(rows[-1] + 1 + halo, region.shape[0]))
+        xs = slice(max(cols[0] - halo, 0), min(cols[-1] + 1 + halo, region.shape[1]))
+        print('Updating sub-domain', (ys.start, ys.stop), (xs.start, xs.stop))
+
+        sub_lon = lon[ys, xs] if lon.ndim == 2 else lon[xs]
+        sub_lat = lat[ys, xs] if lat.ndim == 2 else lat[ys]
+        self.read_img(torig[ys, xs], sub_lon, sub_lat, **(read_kwargs or {}))
+        self.applyWavelet(**(wavelet_kwargs or {}))
+        self.scaleWeighting(wtype=wtype, data_tag=data_tag)
+
+        new_pos = getattr(self, 'max_pos', None)
+        if new_pos is prev['max_pos']:
+            new_pos = None  # not set by the sub-domain run
+        if (prev['scale_weighted'] is None) and (self.scale_weighted is not None):
+            # no cores in the previous run
+            prev['scale_weighted'] = np.zeros(self.scale_weighted.shape[:-2] + region.shape,
+                                              dtype=self.scale_weighted.dtype)
+
+        sub = region[ys, xs]
+        for name in ['scale_weighted', 'image', 'area', 'invalid', 'power', 'coeffs', 'raw_power', 'power_sum']:
+            full, part = prev[name], getattr(self, name)
+            if full is None:
+                continue
+            if (part is None) and (name != 'scale_weighted'):
+                # streamed sub-domain: the previous cubes can't be updated
+                prev[name] = None
+                continue
+            window = full[..., ys, xs]
+            window[..., sub] = 0 if part is None else part[..., sub]  # filters return None if no cores are found
+
+        if isinstance(prev['max_pos'], dict):
+            self.max_pos = _merge_cores(prev['max_pos'], new_pos, region, lon, lat)
+
+        self.original = torig
+        self.lon = lon
+        self.lat = lat
+        for name in ['scale_weighted', 'image', 'area', 'invalid', 'power', 'coeffs', 'raw_power', 'power_sum']:
+            setattr(self, name, prev[name])
+        self._stream = None
+        self._power_std = {}
+        self.updated = region
+
+        return self.scale_weighted
+
+
+
+    def _cloud_labels(self, torig):
+        """
+        Labelled clouds of a cloud top temperature image, as identified in read_img (before the area filter).
+        """
+        t = self._working_copy(torig)
+        t[(t >= self.Tcut) | (t <= -150) | np.isnan(t)] = 0
+        return label(t)[0]
+
+
+
+def _axes(lat, lon):
+    """
+    1d latitude and longitude axes of regular 1d or 2d coordinates.
+    """
+    latitudes = lat[:, 0] if lat.ndim == 2 else lat
+    longitudes = lon[0, :] if lon.ndim == 2 else lon
+    return latitudes, longitudes
+
+
+
+def _touching(labels, mask):
+    """
+    Mask of all labelled objects with at least one pixel in mask.
+    """
+    hit = np.zeros(labels.max() + 1, dtype=bool)  # label -> touched lookup table
+    hit[labels[mask]] = True
+    hit[0] = False
+    return hit[labels]
+
+
+
+def _merge_cores(old, new, region, lon, lat):
+    """
+    Merges core location dictionaries (lat, lon, ...) as returned by power filters: cores of old outside of region,
+    cores of new inside.
+    """
+    latitudes, longitudes = _axes(lat, lon)
+
+    def inside(cores):
+        iy = np.abs(latitudes[np.newaxis, :] - np.asarray(cores['lat'])[:, np.newaxis]).argmin(axis=1)
+        ix = np.abs(longitudes[np.newaxis, :] - np.asarray(cores['lon'])[:, np.newaxis]).argmin(axis=1)
+        return region[iy, ix] if len(cores['lat']) else np.zeros(0, dtype=bool)
+
+    keep_old = ~inside(old)
+    keep_new = inside(new) if new is not None else np.zeros(0, dtype=bool)
+    merged = {}
+    for key in old:
+        merged[key] = [v for v, k in zip(old[key], keep_old) if k]
+        if new is not None:
+            merged[key] += [v for v, k in zip(new[key], keep_new) if k]
+    return merged
+
+
+
+def _collect(results, writer=None, tracker=None):
+    """
+    Time slot results of process_stack as list, or appended to writer one by one as they arrive. With tracker, results
+    are (output, cores) pairs (see dataset._process_slot) and the cores are tracked as they arrive, in input order.
+    """
+    if tracker is not None:
+        results = _track_slots(results, tracker)
+    if writer is None:
+        return list(results)
+    for ds in results:
+        if ds is not None:
+            writer.append(ds)
+
+
+
+def _track_slots(results, tracker):
+    """
+    Passes the cores of (output, cores) time slot results to tracker.update and yields the outputs, see _collect.
+    """
+    for ds, cores in results:
+        if cores is not None:
+            tracker.update(*cores)
+        yield ds
+
+
+
+def _chain(batches):
+    """
+    Flattens the per-batch result lists of process_stack(batch_size=...) lazily, in input order.
+    """
+    for batch in batches:
+        for ds in batch:
+            yield ds
+
+
+
+def _slot_refs(data, varname=None):
+    """
+    List of time slot references of a (time, lat, lon) DataArray or a list of netCDF files: 2d DataArrays, or
+    (path, variable, time index) tuples for files, which are only read on demand (see _load_slot).
+    """
+    if isinstance(data, xr.DataArray):
+        if 'time' in data.dims:
+            return [data.isel(time=tt) for tt in range(data.sizes['time'])]
+        return [data.squeeze()]
+
+    refs = []
+    for path in data:
+        with xr.open_dataset(path) as fds:
+            var = varname if varname is not None else list(fds.data_vars)[0]
+            if 'time' in fds[var].dims:
+                refs.extend([(path, var, tt) for tt in range(fds[var].sizes['time'])])
+            else:
+                refs.append((path, var, None))
+    return refs
+
+
+
+def _load_slots(refs):
+    """
+    Returns the 2d DataArrays of a list of time slot references from _slot_refs. Each file is opened once per process
+    (see _files) and stays open while its slots are read: files that refs don't reference any more are closed.
+    """
+    keys = set((ref[0], ref[1]) for ref in refs if not isinstance(ref, xr.DataArray))
+    for key in list(_files):
+        if key not in keys:
+            _files.pop(key).close()
+
+    out = []
+    for ref in refs:
+        if isinstance(ref, xr.DataArray):
+            out.append(ref)
+            continue
+        path, var, tt = ref
+        if (path, var) not in _files:
+            _files[(path, var)] = ioUtils.open_tir(path, varname=var)
+        da = _files[(path, var)]
+        out.append(da.isel(time=tt) if tt is not None else da.squeeze())
+    return out
+
+
+
+def _load_slot(ref):
+    """
+    Returns the 2d DataArray of a time slot reference from _slot_refs, see _load_slots.
+    """
+    return _load_slots([ref])[0]
+
+
+
+def _close_files():
+    """
+    Closes the files opened by _load_slots in this process.
+    """
+    while _files:
+        _files.popitem()[1].close()
+
+
+
+# per-process open files of _load_slots: (path, variable) -> lazy DataArray
+_files = {}
+
+
+
+# per-process state of process_stack worker processes
+_worker = {}
+
+# per-thread dataset object of process_lazy: one per thread, released with the thread
+_lazy_local = threading.local()
+
 
+def _init_worker(dataname, setup, run_kwargs):
+    _worker['obj'] = dataset(dataname, **setup)
+    _worker['run_kwargs'] = run_kwargs
 
 
+def _run_worker(ref):
+    return _worker['obj']._process_slot(_load_slot(ref), **_worker['run_kwargs'])
 
 
+def _run_worker_batch(refs):
+    return _worker['obj']._process_batch(_load_slots(refs), **_worker['run_kwargs'])
 
 
+def _lazy_block(block, lon=None, lat=None, dataname=None, setup=None, run_kwargs=None):
+    """
+    Computes the int16 scale-weighted power for a (..., lat, lon) block of time slots, see process_lazy.
+    Time slots without valid power (e.g. no clouds) are set to 0.
+    """
+    key = (dataname, repr(sorted(setup.items())))
+    if getattr(_lazy_local, 'key', None) != key:
+        _lazy_local.key = key
+        _lazy_local.obj = dataset(dataname, **setup)
+    obj = _lazy_local.obj
 
+    out = np.zeros(block.shape, dtype=np.int16)
+    for ids in np.ndindex(block.shape[:-2]):
+        obj.read_img(block[ids], lon, lat, **run_kwargs['read_kwargs'])
+        obj.applyWavelet(**run_kwargs['wavelet_kwargs'])
+        power = obj.scaleWeighting(wtype=run_kwargs['wtype'], data_tag=run_kwargs['data_tag'])
+        if isinstance(power, tuple):
+            power = power[0]
+        if power is not None:
+            out[ids] = np.round(power, 0).astype(np.int16)
+    return out
 
 
 
+def _save_netcdf(ds, filepath, CLOBBER=False):
+    """
+    Saves dataset to netCDF4 with zlib compression.
+    """
+    if CLOBBER:
+        if os.path.isfile(filepath):
+            os.remove(filepath)
+    comp = dict(zlib=True, complevel=5)
+    enc = {var: comp for var in ds.data_vars}
 
+    ds.to_netcdf(path=filepath, mode='w', encoding=enc, format='NETCDF4')
+    print('Saved ' + filepath)
@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import xarray as xr
+import os
+import shutil
+
+try:
+    import netCDF4
+except ImportError:
+    netCDF4 = None
+
+try:
+    import numcodecs
+except ImportError:
+    numcodecs = None
+
+
+FORMATS = ['netcdf', 'zarr']
+CODECS = ['zlib', 'zstd', 'lz4', 'blosc']
+
+# codec names of the netCDF4 library (compression keyword of createVariable)
+_NETCDF_CODECS = {'zlib': 'zlib', 'zstd': 'zstd', 'lz4': 'blosc_lz4', 'blosc': 'blosc_lz'}
+# netCDF4 module flags of codecs that need optional netCDF-C filter plugins
+_NETCDF_SUPPORT = {'zstd': '__has_zstandard_support__', 'lz4': '__has_blosc_support__', 'blosc': '__has_blosc_support__'}
+
+# units all time slots of a store are encoded in, so that appended slots can be converted without xarray
+TIME_UNITS = 'seconds since 1970-01-01 00:00:00'
+
+
+def open_tir(filepath, varname=None, engine=None):
+    """
+    Opens the TIR variable of a NetCDF / HDF5 file lazily: only metadata is read, data of a time slot is read when it
+    is accessed (e.g. by np.array in cores.dataset.read_img) and is not cached in the returned DataArray, so that a
+    slot only ever exists in memory as read_img working copy.
+    :param filepath: path to NetCDF4 / HDF5 file, e.g. testdata/tir_testfile.nc
+    :param varname: variable name. Default: first data variable
+    :param engine: optional xarray backend engine, e.g. 'h5netcdf'
+    :return: lazy (time, lat, lon) or (lat, lon) DataArray. Its close() closes the file.
+    """
+    ds = xr.open_dataset(filepath, engine=engine, cache=False)
+    var = varname if varname is not None else list(ds.data_vars)[0]
+    da = ds[var]
+    da.set_close(ds.close)
+    return da
+
+
+
+def open_raw(filepath, shape, dtype='int16', lon=None, lat=None, time=None, offset=0, order='C'):
+    """
+    Memory-maps a raw binary TIR grid file (one or more time slots of fixed shape). Nothing is read until a time slot
+    is accessed, and pages are read from disk by the operating system on demand.
+    Use t_scale / t_offset of read_img to unpack packed integer data within the read_img working copy.
+    :param filepath: path to the binary file
+    :param shape: (lat, lon) or (time, lat, lon) shape of the grid
+    :param dtype: numpy data type of the stored values, including byte order (e.g. '>i2' for big endian int16)
+    :param lon: optional 1d longitudes (default: pixel index)
+    :param lat: optional 1d latitudes (default: pixel index)
+    :param time: optional 1d times of the time slots
+    :param offset: header size in bytes before the first value
+    :param order: 'C' (row-major, default) or 'F' (column-major) storage order
+    :return: memory-mapped DataArray
+    """
+    arr = np.memmap(filepath, dtype=dtype, mode='r', offset=offset, shape=tuple(shape), order=order)
+    dims = ['time', 'lat', 'lon'][-arr.ndim:]
+    coords = {'lat': lat if lat is not None else np.arange(arr.shape[-2]),
+              'lon': lon if lon is not None else np.arange(arr.shape[-1])}
+    if (arr.ndim == 3) and (time is not None):
+        coords['time'] = time
+    return xr.DataArray(arr, coords=coords, dims=dims)
+
+
+
+class writer(object):
+
+    def __init__(self, filepath, format=None, codec='zlib', level=5, chunks=None, CLOBBER=False):
+        """
+        Appendable writer for the output of cores.dataset.to_dataarray: successive time slots are streamed into one
+        chunked, compressed Zarr store or NetCDF4 file along an unlimited time dimension instead of one file per slot.
+        The int8/int16 quantisation and the scaling_factor attribute of to_dataarray are kept as they are.
+        Use as context manager or call close() after the last slot.
+        :param filepath: path of the NetCDF file or Zarr store
+        :param format: 'netcdf' or 'zarr'. Default: 'zarr' for paths ending with .zarr, otherwise 'netcdf'
+        :param codec: compressor: 'zlib' (default), 'zstd', 'lz4' or 'blosc' (blosclz). For Zarr, all but zlib are
+                      Blosc compressors (numcodecs). For NetCDF, zstd and the blosc codecs need netCDF4 built with the
+                      respective filter support, otherwise zlib is used.
+        :param level: compression level (default: 5)
+        :param chunks: dictionary of chunk sizes per dimension, e.g. {'time': 1, 'lat': 256, 'lon': 256}.
+                       Default: one time slot per chunk, full size along all other dimensions
+        :param CLOBBER: if True, overwrites an existing file or store. Otherwise, slots are appended to it.
+        """
+        if format is None:
+            format = 'zarr' if filepath.rstrip('/').endswith('.zarr') else 'netcdf'
+        if format not in FORMATS:
+            raise ValueError('Format not found. Choose one of ' + str(FORMATS))
+        if codec not in CODECS:
+            raise ValueError('Codec not found. Choose one of ' + str(CODECS))
+        if (format == 'netcdf') and (netCDF4 is None):
+            raise ImportError('The netcdf writer requires the netCDF4 package')
+        if (format == 'zarr') and (numcodecs is None):
+            raise ImportError('The zarr writer requires the zarr and numcodecs packages')
+
+        self.filepath = filepath
+        self.format = format
+        self.codec = codec
+        self.level = level
+        self.chunks = chunks or {}
+        self.nslots = 0
+
+        if CLOBBER:
+            _remove(filepath)
+        self._exists = os.path.exists(filepath)
+        self._nc = None
+
+
+
+    def append(self, ds):
+        """
+        Appends one or more time slots (xarray dataset with a time dimension, as from to_dataarray with date).
+        :param ds: xarray dataset
+        """
+        if 'time' not in ds.dims:
+            print('Dataset has no time dimension, please provide a date to to_dataarray. Slot not written.')
+            return
+
+        if self.format == 'zarr':
+            self._append_zarr(ds)
+        else:
+            self._append_netcdf(ds)
+        self.nslots += ds.sizes['time']
+
+
+
+    def close(self):
+        """
+        Closes the output file.
+        """
+        if self._nc is not None:
+            self._nc.close()
+            self._nc = None
+        print('Saved ' + str(self.nslots) + ' time slots to ' + self.filepath)
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
+
+    def _chunks(self, var):
+        """
+        Chunk shape of a variable, see chunks.
+        """
+        return tuple(min(self.chunks.get(dim, 1 if dim == 'time' else size), size)
+                     for dim, size in zip(var.dims, var.shape))
+
+
+    def _append_zarr(self, ds):
+        if self._exists:
+            ds.to_zarr(self.filepath, mode='a', append_dim='time')
+            return
+
+        if self.codec == 'zlib':
+            compressor = numcodecs.Zlib(level=self.level)
+        else:
+            cname = {'zstd': 'zstd', 'lz4': 'lz4', 'blosc': 'blosclz'}[self.codec]
+            compressor = numcodecs.Blosc(cname=cname, clevel=self.level, shuffle=numcodecs.Blosc.BITSHUFFLE)
+
+        enc = {var: {'compressor': compressor, 'chunks': self._chunks(ds[var])} for var in ds.data_vars}
+        enc['time'] = {'units': TIME_UNITS, 'dtype': np.float64}
+        ds.to_zarr(self.filepath, mode='w-', encoding=enc)
+        self._exists = True
+
+
+    def _append_netcdf(self, ds):
+        if not self._exists:
+            compression = _NETCDF_CODECS[self.codec]
+            if (compression != 'zlib') and not getattr(netCDF4, _NETCDF_SUPPORT[self.codec], False):
+                print('netCDF4 library without ' + self.codec + ' support, falling back to zlib')
+                compression = 'zlib'
+            enc = {var: {'compression': compression, 'complevel': self.level, 'chunksizes': self._chunks(ds[var])}
+                   for var in ds.data_vars}
+            enc['time'] = {'units': TIME_UNITS, 'dtype': np.float64}
+            ds.to_netcdf(path=self.filepath, mode='w', encoding=enc, format='NETCDF4', unlimited_dims=['time'])
+            self._exists = True
+            return
+
+        if self._nc is None:
+            self._nc = netCDF4.Dataset(self.filepath, 'a')
+        nc = self._nc
+
+        n0 = len(nc.dimensions['time'])
+        n1 = n0 + ds.sizes['time']
+        nc['time'][n0:n1] = (ds['time'].values - np.datetime64('1970-01-01')) / np.timedelta64(1, 's')
+        for var in ds.data_vars:
+            if 'time' not in ds[var].dims:
+                continue
+            data = ds[var].transpose('time', *[dim for dim in nc[var].dimensions if dim != 'time']).values
+            nc[var][n0:n1] = data
+        nc.sync()
+
+
+
+def _remove(filepath):
+    """
+    Removes a file or directory store.
+    """
+    if os.path.isdir(filepath):
+        shutil.rmtree(filepath)
+    elif os.path.isfile(filepath):
+        os.remove(filepath)
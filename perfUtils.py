@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+import contextlib
+import logging
+import threading
+import time
+import tracemalloc
+
+
+class profiler(object):
+
+    def __init__(self, callbacks=None, logger=None, level=logging.INFO, memory=False):
+        """
+        Opt-in instrumentation of the ccores pipeline (see cores.dataset(profiler=...)). Every instrumented stage of
+        a run produces one record (dictionary) with the stage name, start time, wall time in seconds, array sizes
+        of the stage and the current tags (e.g. the time slot). Stages: read_img, label, wavelet, fft_forward,
+        fft_inverse (one record per scale), threshold, weighting and io.
+        Records are collected in self.records, passed to callbacks and optionally logged.
+        :param callbacks: list of functions called with each record as soon as a stage ends
+        :param logger: logging.Logger or logger name to log records to (default: None, no logging)
+        :param level: logging level of records (default: logging.INFO)
+        :param memory: if True, records the peak of traced (Python and numpy) memory allocations per stage in MB via
+                       tracemalloc. This slows down the run.
+        """
+        self.records = []
+        self.callbacks = list(callbacks or [])
+        self.logger = logging.getLogger(logger) if isinstance(logger, str) else logger
+        self.level = level
+        self.memory = memory
+        self.tags = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+
+
+    @contextlib.contextmanager
+    def stage(self, name, **info):
+        """
+        Context manager timing one stage. Yields the record (dictionary), to which the stage can add further
+        information, e.g. array sizes.
+        :param name: stage name
+        :param info: additional record entries
+        """
+        record = dict(stage=name, start=time.time(), **self.tags)
+        record.update(info)
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+
+        if self.memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            current, peak = tracemalloc.get_traced_memory()
+            if stack:
+                stack[-1]['_peak'] = max(stack[-1]['_peak'], peak)  # keep the enclosing stage's peak before reset
+            tracemalloc.reset_peak()
+            record['_base'], record['_peak'] = current, current
+        stack.append(record)
+
+        t0 = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record['seconds'] = time.perf_counter() - t0
+            stack.pop()
+            if self.memory:
+                peak = max(record.pop('_peak'), tracemalloc.get_traced_memory()[1])
+                record['peak_mb'] = (peak - record.pop('_base')) / 1024. ** 2
+                if stack:
+                    stack[-1]['_peak'] = max(stack[-1]['_peak'], peak)
+            self._emit(record)
+
+
+
+    def _emit(self, record):
+        with self._lock:
+            self.records.append(record)
+        for callback in self.callbacks:
+            callback(record)
+        if self.logger is not None:
+            self.logger.log(self.level, 'ccores %s', record)
+
+
+
+    def add_callback(self, callback):
+        """
+        Adds a function called with each record.
+        """
+        self.callbacks.append(callback)
+
+
+
+    def summary(self):
+        """
+        Total wall time, number of calls and maximum peak memory (if recorded) per stage.
+        :return: dictionary stage -> dictionary(seconds, calls[, peak_mb])
+        """
+        out = {}
+        for record in self.records:
+            entry = out.setdefault(record['stage'], dict(seconds=0., calls=0))
+            entry['seconds'] += record['seconds']
+            entry['calls'] += 1
+            if 'peak_mb' in record:
+                entry['peak_mb'] = max(entry.get('peak_mb', 0.), record['peak_mb'])
+        return out
+
+
+
+    def clear(self):
+        """
+        Removes all records.
+        """
+        with self._lock:
+            self.records = []
+
+
+
+def stage(prof, name, **info):
+    """
+    prof.stage(name, **info) if a profiler is given, otherwise a no-op context yielding a throwaway record.
+    """
+    if prof is None:
+        return contextlib.nullcontext({})
+    return prof.stage(name, **info)
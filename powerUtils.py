@@ -2,8 +2,195 @@
 import numpy as np
 from scipy import ndimage
 from scipy.ndimage.measurements import label
+from ccores import wav
 
-def find_power_nflics(coreObj):
+
+def _sum_scales(coreObj, *selections, std_normed=False):
+    """
+    Sums wavelet power over scales in a single pass over coreObj.iter_power(), i.e. works without the full power cube
+    when the wavelet was applied in streaming mode. The sum over all scales is taken from coreObj.power_sum if kept.
+    :param coreObj: cores.dataset object
+    :param selections: one boolean mask or index array over coreObj.scales per requested sum. Without selections, all
+                       scales are summed.
+    :param std_normed: if True, each power slice is divided by its standard deviation (see _power_std)
+    :return: list of 2d power sums, one per selection
+    """
+    nb = len(coreObj.scales)
+    if len(selections) == 0:
+        if (getattr(coreObj, 'power_sum', None) is not None) and not std_normed:
+            return [coreObj.power_sum.copy()]  # kept by applyWavelet(products=[..., 'power_sum'])
+        selections = [np.ones(nb, dtype=bool)]
+    masks = [np.isin(np.arange(nb), np.arange(nb)[sel]) for sel in selections]
+
+    sums = [None] * len(masks)
+    tmp = None
+    for ids, power in enumerate(coreObj.iter_power()):
+        if not any(m[ids] for m in masks):
+            continue
+        if std_normed:
+            if tmp is None:
+                tmp = np.empty_like(power)
+            power = np.divide(power, _power_std(coreObj, ids, power, tmp), out=tmp)
+        for i, m in enumerate(masks):
+            if not m[ids]:
+                continue
+            if sums[i] is None:
+                sums[i] = power.copy()
+            else:
+                sums[i] += power
+
+    for i in range(len(sums)):
+        if sums[i] is None:
+            sums[i] = np.zeros_like(coreObj.image)
+    return sums
+
+
+def _power_std(coreObj, ids, power, tmp=None):
+    """
+    Standard deviation of the wavelet power of scale ids, computed once per applyWavelet and shared by the filters
+    normalising power per scale (individual, dominant).
+    :param coreObj: cores.dataset object
+    :param ids: scale index
+    :param power: 2d power of the scale
+    :param tmp: optional scratch array of the shape and dtype of power, see wav.std
+    """
+    cache = getattr(coreObj, '_power_std', None)
+    if cache is None:
+        cache = coreObj._power_std = {}
+    if ids not in cache:
+        cache[ids] = wav.std(power, tmp)
+    return cache[ids]
+
+
+def _label_stats(labels, numL, values, mode='min'):
+    """
+    Per-label size and position of the minimum (mode='min') or maximum (mode='max') value in a single labelled pass
+    instead of one full-image scan per label. Positions are found via a sort-based group-by over labelled pixels,
+    ties resolve to the first position in C order and NaN counts as extremum like np.argmin / np.argmax.
+    :param labels: 2d label image (0: background), e.g. from scipy.ndimage.label
+    :param numL: number of labels
+    :param values: 2d array to find per-label extrema in
+    :param mode: 'min' or 'max'
+    :return: sizes: 1d array (numL+1), number of pixels per label, index 0 is the background
+             pos: 1d array (numL), flat index of the label extremum for labels 1..numL (-1 for empty labels)
+    """
+    flat_labels = labels.ravel()
+    sizes = np.bincount(flat_labels, minlength=numL + 1)
+
+    idx = np.flatnonzero(flat_labels)
+    lab = flat_labels[idx]
+    vals = values.ravel()[idx]
+    if mode == 'max':
+        vals = -vals
+
+    nan = np.isnan(vals)
+    order = np.lexsort((idx, np.where(nan, 0, vals), ~nan, lab))  # sorted by label, then NaN first, value, position
+    lab = lab[order]
+    first = np.ones(lab.size, dtype=bool)
+    first[1:] = lab[1:] != lab[:-1]
+
+    pos = np.full(numL, -1, dtype=np.intp)
+    pos[lab[first] - 1] = idx[order][first]
+
+    return sizes, pos
+
+
+def _small_cores(sizes, res, scale):
+    """
+    Label lookup table of cores that don't reach the minimum wavelet scale representing noise (background excluded).
+    :param sizes: number of pixels per label, see _label_stats
+    :param res: pixel resolution
+    :param scale: minimum wavelet scale
+    """
+    small = sizes * res ** 2 < (np.pi * (int(scale) ** 2)) / 4
+    small[0] = False
+    return small
+
+
+# columns of the core tables returned by the power filters with table=True
+CORE_TABLE_COLUMNS = ['label', 'y', 'x', 'lat', 'lon', 'area', 'tmin', 'power_max', 'scale']
+
+
+def _core_table(coreObj, labels, ids, pos, power_img, scale=None, scale_sel=None):
+    """
+    Columnar core table: one 1d array per column in CORE_TABLE_COLUMNS, one entry per core. Per-core values are
+    gathered at the core centres or reduced over the labelled core pixels, so that no full image has to be rescanned
+    for centre values later. Convert with e.g. pandas.DataFrame(table).
+    :param coreObj: cores.dataset object
+    :param labels: 2d label image of the cores
+    :param ids: label ids of the cores
+    :param pos: flat indices of the core centres
+    :param power_img: power image the cores were identified in, before centres were encoded
+    :param scale: optional scale of each core. Default: scale of maximum wavelet power at the core centre (from
+                  coreObj.iter_power() if the power cube is not kept)
+    :param scale_sel: optional boolean mask over coreObj.scales limiting the scales for the default scale
+    :return: dictionary of 1d arrays
+    """
+    ids = np.asarray(ids, dtype=labels.dtype)
+    pos = np.asarray(pos, dtype=np.intp)
+    posy, posx = np.unravel_index(pos, labels.shape)
+
+    if coreObj.lat.ndim == 2:
+        lats = coreObj.lat.flat[pos]
+        lons = coreObj.lon.flat[pos]
+    else:
+        lats = coreObj.lat[posy]
+        lons = coreObj.lon[posx]
+
+    tmin, power_max = _label_reduce(labels, ids, (coreObj.image, np.minimum), (power_img, np.maximum))
+
+    if scale is None:
+        nb = len(coreObj.scales)
+        sel = np.ones(nb, dtype=bool) if scale_sel is None else np.isin(np.arange(nb), np.arange(nb)[scale_sel])
+        if coreObj.power is not None:
+            centre_power = coreObj.power.reshape(len(coreObj.scales), -1)[:, pos][sel]
+            scale = coreObj.scales[sel][np.argmax(centre_power, axis=0)]
+        else:
+            # streamed power: running maximum over the scales at the centres (first maximum wins, as np.argmax)
+            best = np.full(pos.size, -np.inf)
+            scale = np.zeros(pos.size)
+            for inds, power in enumerate(coreObj.iter_power()):
+                if not sel[inds]:
+                    continue
+                centre_power = power.flat[pos]
+                larger = centre_power > best
+                best[larger] = centre_power[larger]
+                scale[larger] = coreObj.scales[inds]
+    scale = np.broadcast_to(np.asarray(scale, dtype=float), pos.shape).copy()
+
+    return {'label': ids, 'y': posy, 'x': posx, 'lat': np.asarray(lats), 'lon': np.asarray(lons),
+            'area': coreObj.area.flat[pos], 'tmin': tmin, 'power_max': power_max, 'scale': scale}
+
+
+def _label_reduce(labels, ids, *reductions):
+    """
+    Per-label reductions over the labelled pixels only, grouped by a single sort of the label ids.
+    :param labels: 2d label image (0: background)
+    :param ids: label ids to return reductions for
+    :param reductions: (2d array, numpy ufunc) pairs, e.g. (image, np.minimum)
+    :return: list of 1d arrays, one per reduction, with one value per id
+    """
+    if ids.size == 0:
+        return [np.zeros(0, dtype=values.dtype) for values, ufunc in reductions]
+
+    idx = np.flatnonzero(labels)
+    lab = labels.ravel()[idx]
+    order = np.argsort(lab, kind='stable')
+    lab = lab[order]
+    first = np.flatnonzero(np.r_[True, lab[1:] != lab[:-1]])
+    at = np.searchsorted(lab[first], ids)
+
+    return [ufunc.reduceat(values.ravel()[idx][order], first)[at] for values, ufunc in reductions]
+
+
+def _concat_tables(tables):
+    """
+    Concatenates core tables (see _core_table) row-wise.
+    """
+    return {col: np.concatenate([t[col] for t in tables]) for col in CORE_TABLE_COLUMNS}
+
+
+def find_power_nflics(coreObj, table=False):
     """
     THIS POWER FILTER IS CURRENTLY (20/05/21) RUNNING IN THE NFLICS NOWCASTING TOOL AT 5km RESOLUTION (MSG dataset)
     Related dataset name: METEOSAT5K_vera (constants.py)
@@ -15,6 +202,7 @@ def find_power_nflics(coreObj):
     :param no_good: mask indicating cloud areas that are accepted for dominant power detection
     :param area: 2d array indicating the number of pixels per MCS
     :param dataset: string to define input dataset for threshold setting
+    :param table: if True, additionally returns a core table (see _core_table)
     :return: 2d array of dominant power areas, negative values indicate max power centres and give MCS area in
              number of pixels (-200 at 5km resolution = MCS of 5000km2)
 
@@ -32,7 +220,7 @@ def find_power_nflics(coreObj):
 
     print('Assuming Meteosat ' + str(coreObj.data_tag) +' dataset. If incorrect, please set explicit data_tag keyword for .scaleWeighting')
 
-    power_img = np.sum(coreObj.power, axis=0)
+    power_img = _sum_scales(coreObj)[0]
     power_img[coreObj.invalid] = 0
 
     try:
@@ -48,21 +236,19 @@ def find_power_nflics(coreObj):
         return
 
     labels, numL = label(power_img)
-    u, inv = np.unique(labels, return_inverse=True)
+    sizes, pos = _label_stats(labels, numL, power_img, mode='max')
 
-    for inds in u:
-        if inds == 0:
-            continue
+    if table:
+        cores = _core_table(coreObj, labels, np.arange(1, numL + 1), pos, power_img)
 
-        arr = power_img.copy()
-        arr[np.where(labels != inds)] = 0
-        pos = np.argmax(arr)
-        power_img.flat[pos] = coreObj.area.flat[pos]*(-1)
+    power_img.flat[pos] = coreObj.area.flat[pos]*(-1)  # centre at max power location
 
+    if table:
+        return (power_img, cores)
     return power_img
 
 
-def find_power_nflics3k(coreObj):
+def find_power_nflics3k(coreObj, table=False):
     """
    Similar to nflics operational, but with increased threshold for optimisation with nflics3k setup (~3km on native meteosat grid)
 
@@ -78,7 +264,7 @@ def find_power_nflics3k(coreObj):
     Can directly used for frequency analysis though.
     """
 
-    power_img = np.sum(coreObj.power, axis=0)
+    power_img = _sum_scales(coreObj)[0]
     power_img[coreObj.invalid] = 0
 
     thresh_p = np.sum((coreObj.scales) ** .5)  * len(coreObj.scales)*0.25 # set different power threshold adjustments to datasets
@@ -89,38 +275,34 @@ def find_power_nflics3k(coreObj):
         return
 
     labels, numL = label(power_img)
-    u, inv = np.unique(labels, return_inverse=True)
+    sizes, pos = _label_stats(labels, numL, power_img, mode='max')
 
-    maxdic = {'lat' : [], 'lon' : [], 'area_pixels' : []}
+    # remove cores that don't reach minimum wavelet scale representing noise.
+    small = _small_cores(sizes, coreObj.res, coreObj.scales[0])
+    power_img[small[labels]] = 0
 
-    for inds in u:
-        if inds == 0:
-            continue
+    ids = np.arange(1, numL + 1)[~small[1:]]
+    pos = pos[~small[1:]]
+    ids = ids[power_img.flat[pos] > 0]
+    pos = pos[power_img.flat[pos] > 0]
+    #power_img.flat[pos] = coreObj.area.flat[pos]*(-1)
 
-        arr = power_img.copy()
+    if coreObj.lat.ndim == 2:
+        lats = coreObj.lat.flat[pos]
+        lons = coreObj.lon.flat[pos]
+    else:
+        posy, posx = np.unravel_index(pos, power_img.shape)
+        lats = coreObj.lat[posy]
+        lons = coreObj.lon[posx]
 
-        # remove cores that don't reach minimum wavelet scale representing noise.
-        if np.sum(labels == inds) * coreObj.res ** 2 < (np.pi * (int(coreObj.scales[0]) ** 2)) / 4:
-            power_img[np.where(labels == inds)] = 0
-            continue
-
-        arr[np.where(labels != inds)] = 0
-        pos = np.argmax(arr)
-        #power_img.flat[pos] = coreObj.area.flat[pos]*(-1)
-        if arr.flat[pos]  > 0:
-            if coreObj.lat.ndim == 2:
-                maxdic['lat'].append(coreObj.lat.flat[pos])
-                maxdic['lon'].append(coreObj.lon.flat[pos])
-            else:
-                posy, posx = np.unravel_index(pos, arr.shape)
-                maxdic['lat'].append(coreObj.lat[posy])
-                maxdic['lon'].append(coreObj.lon[posx])
-            maxdic['area_pixels'].append(coreObj.area.flat[pos])
+    maxdic = {'lat' : list(lats), 'lon' : list(lons), 'area_pixels' : list(coreObj.area.flat[pos])}
 
+    if table:
+        return (power_img, maxdic, _core_table(coreObj, labels, ids, pos, power_img))
     return (power_img, maxdic)
 
 
-def find_power_nflicsv2(coreObj):
+def find_power_nflicsv2(coreObj, table=False):
 
     """
 
@@ -146,21 +328,22 @@ def find_power_nflicsv2(coreObj):
 
     if np.max(coreObj.scales > large_scale):  # large scale threshold adjustment
 
-        power_img = np.sum(coreObj.power[0:np.max(mpos), :, :], axis=0)
+        small_sum, large_sum = _sum_scales(coreObj, slice(0, np.max(mpos)), slice(np.min(pos), None))
+        power_img = small_sum.copy()
 
         thresh_ls = np.sum((coreObj.scales[np.min(pos)::])) ** .5 * len(pos[0])*1.5
         thresh_ss = np.sum((coreObj.scales[0:np.max(mpos)])) ** .5 * len(mpos[0])
         thresh_sl = np.sum((coreObj.scales[0:np.max(mpos)])) ** .5 * 0.5
 
         #maskout =  np.sum(coreObj.power[0:np.min(pos), :, :], axis=0) < 1.5*nbl #np.sum(coreObj.power, axis=0)*0.025#1  #np.sum(coreObj.power[0:np.min(pos), :, :]<1, axis=0) > 0.8*nbl
-        ls = (np.sum(coreObj.power[np.min(pos)::, :, :], axis=0) > thresh_ls)
-        ss = (np.sum(coreObj.power[0:np.max(mpos), :, :], axis=0) > thresh_ss)
-        sl = (np.sum(coreObj.power[0:np.max(mpos), :, :], axis=0) > thresh_sl)
+        ls = (large_sum > thresh_ls)
+        ss = (small_sum > thresh_ss)
+        sl = (small_sum > thresh_sl)
 
         mask = (ls & sl) | ss  #ss |
 
     else:
-        power_img = np.sum(coreObj.power, axis=0)
+        power_img = _sum_scales(coreObj)[0]
         thresh_all = np.sum((coreObj.scales) ** .5) * len(mpos[0])
         mask = power_img > thresh_all
 
@@ -173,24 +356,20 @@ def find_power_nflicsv2(coreObj):
         return
 
     labels, numL = label(power_img)
-    u, inv = np.unique(labels, return_inverse=True)
-
-
-    for inds in u:
-        arr = coreObj.image.copy()
-        if inds == 0:
-            continue
-
-        if np.sum(labels == inds) * coreObj.res**2 < (np.pi * (int(coreObj.scales[0])**2))/4:
-            power_img[np.where(labels==inds)] = 0
-            continue
+    sizes, pos = _label_stats(labels, numL, coreObj.image, mode='min')
 
-        arr[np.where(labels != inds)] = 0
-        pos = np.argmin(arr)
-        power_img.flat[pos] = coreObj.area.flat[pos]*(-1)
+    # remove cores that don't reach minimum wavelet scale representing noise.
+    small = _small_cores(sizes, coreObj.res, coreObj.scales[0])
+    power_img[small[labels]] = 0
 
-    del arr
+    ids = np.arange(1, numL + 1)[~small[1:]]
+    pos = pos[~small[1:]]
+    if table:
+        cores = _core_table(coreObj, labels, ids, pos, power_img)
+    power_img.flat[pos] = coreObj.area.flat[pos]*(-1)  # centre at minT location
 
+    if table:
+        return (power_img, cores)
     return power_img
 
 
@@ -198,7 +377,7 @@ def find_power_nflicsv2(coreObj):
 
 
 
-def find_power_sum(coreObj):
+def find_power_sum(coreObj, table=False):
     """
     Power weighting by scale with <35km small scale preference.
 
@@ -211,11 +390,11 @@ def find_power_sum(coreObj):
     Can directly used for frequency analysis though.
     """
 
-    power_img = coreObj.power.copy()
-    for inds in range(power_img.shape[0]):
+    power_img = None
+    for inds, power in enumerate(coreObj.iter_power()):
 
 
-        slice = power_img[inds,:,:]
+        slice = power.copy()
         if coreObj.scales[inds] > 35:
             tsp = 5
         else:
@@ -227,37 +406,37 @@ def find_power_sum(coreObj):
         except IndexError:
             return slice * 0
 
-    power_img = np.sum(power_img, axis=0)
+        # running sum over thresholded scales
+        if power_img is None:
+            power_img = slice
+        else:
+            power_img += slice
+
     power_img[coreObj.invalid] = 0
 
 
 
     labels, numL = label(power_img)
+    sizes, pos = _label_stats(labels, numL, coreObj.image, mode='min')
 
-    u, cnt = np.unique(labels, return_counts=True)
+    # remove cores that don't reach minimum wavelet scale representing noise.
+    small = _small_cores(sizes, coreObj.res, coreObj.scales[0])
+    power_img[small[labels]] = 0
 
-    for inds, c in zip(u, cnt):
-        if inds == 0:
-            continue
-
-        # remove cores that don't reach minimum wavelet scale representing noise.
-        if c*coreObj.res**2 < (np.pi * (int(coreObj.scales[0])**2))/4:
-            power_img[np.where(labels==inds)] = 0
-            continue
-
-        arr = coreObj.image.copy()
-        arr[np.where(labels != inds)] = 0
-        pos = np.argmin(arr)
-        power_img.flat[pos] = coreObj.area.flat[pos] * (-1)  # centre at minT location
-
-        del arr
+    ids = np.arange(1, numL + 1)[~small[1:]]
+    pos = pos[~small[1:]]
+    if table:
+        cores = _core_table(coreObj, labels, ids, pos, power_img)
+    power_img.flat[pos] = coreObj.area.flat[pos] * (-1)  # centre at minT location
 
+    if table:
+        return (power_img, cores)
     return power_img
 
 
 
 
-def find_power_individual(coreObj):
+def find_power_individual(coreObj, table=False):
     """
     Heavily tuned filter for set scale ranges. Used for testing purposes.
 
@@ -270,20 +449,12 @@ def find_power_individual(coreObj):
     """
 
 
-    wll = coreObj.power.copy()
-
-    for ids in range(wll.shape[0]):
-        arr = wll[ids, :, :]
-        out = arr / np.std(arr)
-        wll[ids, :, :] = out
-
     small = (coreObj.scales>12) & (coreObj.scales<=35)
     medium = (coreObj.scales>35) & (coreObj.scales<65)
     large = coreObj.scales>=65
 
-    psmall = np.sum(wll[small,:,:], axis=0)
-    pmed = np.sum(wll[medium,:,:], axis=0)
-    plarge = np.sum(wll[large,:,:], axis=0)
+    # std-normalised power summed per scale range
+    psmall, pmed, plarge = _sum_scales(coreObj, small, medium, large, std_normed=True)
     scalist = [coreObj.scales[small], coreObj.scales[medium], coreObj.scales[large]]
 
     thresh_ls = np.sum(coreObj.scales[large]) ** .5  *0.9#* len(coreObj.scales[large])*1.5
@@ -325,6 +496,8 @@ def find_power_individual(coreObj):
 
 
     power_img = np.stack([psmall, pmed, plarge], axis=0)
+    ranges = [small, medium, large]
+    tables = []
 
     for idds, pi in enumerate(power_img):
 
@@ -332,35 +505,29 @@ def find_power_individual(coreObj):
 
 
         labels, numL = label(pi)
+        if numL == 0:
+            continue
 
-        u, cnt = np.unique(labels, return_counts=True)
-
-        for inds, c in zip(u, cnt):
-            if inds == 0:
-                continue
-
-
-            # remove cores that don't reach minimum wavelet scale representing noise.
-            if c*coreObj.res**2 < (np.pi * (int(np.min(scalist[idds]))**2))/4:
-                pi[np.where(labels==inds)] = 0
-                continue
-
-            # if c*coreObj.res**2 > (np.pi * (int(np.max(scalist[idds]))**2))/4:
-            #     pi[np.where(labels==inds)] = 0
-            #     continue
-
-            arr = coreObj.image.copy()
-            arr[np.where(labels != inds)] = 0
-            pos = np.argmin(arr)
-            pi.flat[pos] = coreObj.area.flat[pos] * (-1)
-
-            del arr
+        sizes, pos = _label_stats(labels, numL, coreObj.image, mode='min')
 
+        # remove cores that don't reach minimum wavelet scale representing noise.
+        small = _small_cores(sizes, coreObj.res, np.min(scalist[idds]))
+        pi[small[labels]] = 0
+
+        ids = np.arange(1, numL + 1)[~small[1:]]
+        pos = pos[~small[1:]]
+        if table:
+            tables.append(_core_table(coreObj, labels, ids, pos, pi, scale_sel=ranges[idds]))
+        pi.flat[pos] = coreObj.area.flat[pos] * (-1)
+
+    if table:
+        empty = _core_table(coreObj, np.zeros(power_img.shape[1:], dtype=np.int32), [], [], power_img[0])
+        return (power_img, _concat_tables(tables + [empty]))
     return power_img
 
 
 
-def find_power_dominant(coreObj):
+def find_power_dominant(coreObj, table=False):
     """
     This routine identifies dominant scales <150km and identifies areas of dominant power across the power spectrum.
 
@@ -375,17 +542,22 @@ def find_power_dominant(coreObj):
 
 
     ss = coreObj.scales<150
-    wll = coreObj.power[ss,:,:]
+    if coreObj.power is not None:
+        wll = coreObj.power[ss,:,:]
+    else:
+        # the scale maximum filter below needs the power cube, materialised from the streamed scales
+        wll = np.stack([power for power, s in zip(coreObj.iter_power(), ss) if s], axis=0)
     scales = coreObj.scales[ss]
 
 
 
-    for ids in range(wll.shape[0]):
-        arr = wll[ids, :, :]
-        out = arr / np.std(arr)
-        wll[ids, :, :] = out
+    # std-normalised power, in place on the selected scales
+    tmp = np.empty_like(wll[0])
+    for ids, sid in enumerate(np.flatnonzero(ss)):
+        wll[ids, :, :] /= _power_std(coreObj, sid, wll[ids], tmp)
 
     power_img = np.sum(wll, axis=0)*0
+    tables = []
 
 
     maxoutt = (
@@ -416,30 +588,52 @@ def find_power_dominant(coreObj):
         wl[(wl < 1) | (wl - np.mean(vals) <  np.std(vals))] = 0
         labels, numL = label(wl)
 
-        for y, x in zip(yy, xx):
-
-            inds = labels[y,x]
-
-            if inds == 0:
-                continue
-
-            # remove cores that don't reach minimum wavelet scale representing noise.
-            if np.sum(labels == inds) * coreObj.res ** 2 < (np.pi * (int(scales[0]) ** 2)) / 4:
-                power_img[np.where(labels == inds)] = 0
-                continue
-
-            # arr = t.copy()
-            # arr[np.where(labels != inds)] = 0
-            #power_img[arr<0] = scale
-            power_img[labels==inds] = wl[labels==inds] #scale
-
-            arr = coreObj.image.copy() # wl.copy()
-            arr[np.where(labels != inds)] = 0
-            pos = np.argmin(arr)
-            power_img.flat[pos] = scale * (-1) #coreObj.area.flat[pos] * (-1)
-
-
+        # Labels hit by maximum candidates, ordered by their last candidate in the (row-major) candidate scan.
+        # All candidates of a label write the same values, so only the last one counts.
+        hit = labels[yy, xx]
+        hit = hit[hit > 0]
+        if hit.size == 0:
+            continue
+        u, rfirst = np.unique(hit[::-1], return_index=True)
+        ids = u[np.argsort(hit.size - 1 - rfirst)]
 
+        # remove cores that don't reach minimum wavelet scale representing noise.
+        sizes, pos = _label_stats(labels, numL, coreObj.image, mode='min')
+        small = _small_cores(sizes, coreObj.res, scales[0])[ids]
+
+        # label -> 1: noise, set to 0, 2: core, set to power
+        lut = np.zeros(numL + 1, dtype=np.int8)
+        lut[ids[small]] = 1
+        lut[ids[~small]] = 2
+        sel = lut[labels]
+        power_img[sel == 1] = 0
+        core = sel == 2
+        power_img[core] = wl[core] #scale
+
+        # centre: coldest pixel of the core
+        rank = np.full(numL + 1, -1)
+        rank[ids] = np.arange(ids.size)
+        ids = ids[~small]
+        pos = pos[ids - 1]
+        for i in np.flatnonzero(coreObj.image.flat[pos] >= 0):
+            # no pixel below 0: argmin of the image with zeros outside the core, as in the per-core version
+            pos[i] = np.argmin(np.where(labels == ids[i], coreObj.image, 0))
+        # a centre outside its own core only survives if that core came after the one owning the centre pixel
+        last = rank[ids] >= rank[labels.flat[pos]]
+        power_img.flat[pos[last]] = scale * (-1) #coreObj.area.flat[pos] * (-1)
+
+        if table:
+            tables.append(_core_table(coreObj, labels, ids, pos, wl, scale=orig))
+
+
+    if table:
+        cores = _concat_tables(tables + [_core_table(coreObj, np.zeros(power_img.shape, dtype=np.int32), [], [],
+                                                     power_img)])
+        # keep the last core written to each centre, drop centres overwritten by later scales or cores
+        flat = np.ravel_multi_index((cores['y'], cores['x']), power_img.shape)
+        last = flat.size - 1 - np.unique(flat[::-1], return_index=True)[1]
+        last = last[power_img.flat[flat[last]] == -np.round(cores['scale'][last])]
+        return (power_img, {col: cores[col][np.sort(last)] for col in CORE_TABLE_COLUMNS})
     return power_img
 
 
@@ -0,0 +1,13 @@
+import importlib.util
+import os
+import sys
+
+# the repository root is the ccores package: register it as ccores, whatever the name of the checkout directory
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+if 'ccores' not in sys.modules:
+    spec = importlib.util.spec_from_file_location('ccores', os.path.join(ROOT, '__init__.py'),
+                                                  submodule_search_locations=[ROOT])
+    module = importlib.util.module_from_spec(spec)
+    sys.modules['ccores'] = module
+    spec.loader.exec_module(module)
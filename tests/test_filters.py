@@ -0,0 +1,99 @@
+"""
+Regression tests of the power filters (constants.UTILS) and their core tables on the test file.
+testdata/filters_reference.npz holds the filter output of the original implementation (before the vectorised
+filters) and the core tables as introduced with scaleWeighting(core_table=True), for the sub-domain below.
+"""
+import os
+
+import numpy as np
+import pytest
+import xarray as xr
+
+from ccores import constants, cores, powerUtils
+
+REFERENCE = os.path.join(os.path.dirname(constants.TESTDATA), 'filters_reference.npz')
+PRESETS = ['METEOSAT5K_vera', 'METEOSAT5K_veraLS']
+
+
+@pytest.fixture(scope='module')
+def reference():
+    return np.load(REFERENCE)
+
+
+@pytest.fixture(scope='module')
+def datasets():
+    dat = xr.open_dataarray(constants.TESTDATA).squeeze()
+    dat = dat.sel(lat=slice(4, 12), lon=slice(13, 24)) / 100
+    out = {}
+    for preset in PRESETS:
+        obj = cores.dataset(preset)
+        obj.read_img(dat.values.copy(), dat.lon.values, dat.lat.values)
+        obj.applyWavelet()
+        out[preset] = obj
+    return out
+
+
+def _split(result):
+    if isinstance(result, tuple):
+        return result[0], result[1]
+    return result, {}
+
+
+@pytest.mark.parametrize('preset', PRESETS)
+@pytest.mark.parametrize('wtype', list(constants.UTILS))
+def test_filter_matches_baseline(reference, datasets, preset, wtype):
+    image, extra = _split(datasets[preset].scaleWeighting(wtype=wtype))
+    key = preset + '_' + wtype
+    if key not in reference:
+        assert image is None
+        return
+
+    expected = reference[key]
+    assert image.shape == expected.shape
+    np.testing.assert_array_equal(image != 0, expected != 0)  # core areas
+    np.testing.assert_array_equal(image < 0, expected < 0)  # core centres
+    np.testing.assert_allclose(image, expected, rtol=1e-6, atol=1e-6)
+    for name, value in extra.items():
+        np.testing.assert_array_equal(np.asarray(value), reference[key + '_' + name])
+
+
+@pytest.mark.parametrize('preset', PRESETS)
+@pytest.mark.parametrize('wtype', list(constants.UTILS))
+def test_core_table(reference, datasets, preset, wtype):
+    obj = datasets[preset]
+    plain, _ = _split(obj.scaleWeighting(wtype=wtype))
+    image, _ = _split(obj.scaleWeighting(wtype=wtype, core_table=True))
+    table = obj.core_table
+    key = preset + '_' + wtype + '_table_'
+    if not any(name.startswith(key) for name in reference.files):
+        assert table is None
+        return
+
+    if plain is not None:
+        np.testing.assert_array_equal(image, plain)
+    assert list(table) == powerUtils.CORE_TABLE_COLUMNS
+    for col in powerUtils.CORE_TABLE_COLUMNS:
+        np.testing.assert_array_equal(table[col], reference[key + col])
+
+    np.testing.assert_array_equal(table['lat'], obj.lat[table['y']])
+    np.testing.assert_array_equal(table['lon'], obj.lon[table['x']])
+    assert np.all(table['area'] > 0)
+    assert np.all(table['tmin'] <= obj.image[table['y'], table['x']])
+
+
+@pytest.mark.parametrize('wavelet_kwargs', [dict(stream=True), dict(products=('power_sum',))])
+def test_core_table_without_power_cube(datasets, wavelet_kwargs):
+    obj = datasets['METEOSAT5K_vera']
+    obj.scaleWeighting(wtype='sum', core_table=True)
+    expected = obj.core_table
+
+    streamed = cores.dataset('METEOSAT5K_vera')
+    streamed.read_img(obj.original.copy(), obj.lon, obj.lat)
+    streamed.applyWavelet(**wavelet_kwargs)
+    assert streamed.power is None
+    streamed.scaleWeighting(wtype='sum', core_table=True)
+    table = streamed.core_table
+
+    assert not np.any(np.isnan(table['scale']))
+    for col in powerUtils.CORE_TABLE_COLUMNS:
+        np.testing.assert_allclose(table[col], expected[col], rtol=1e-6)
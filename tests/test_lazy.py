@@ -0,0 +1,47 @@
+import numpy as np
+import pytest
+import xarray as xr
+
+from ccores import constants, cores
+
+pytest.importorskip('dask')
+
+
+def _packed_stack():
+    """
+    Two time slots of the test data as int16 hundredths of degrees, chunked per slot.
+    """
+    dat = xr.open_dataarray(constants.TESTDATA).squeeze()
+    dat = dat.sel(lat=slice(4, 12), lon=slice(13, 24))
+    packed = np.round(dat.values).astype(np.int16)
+    times = np.array(['2020-01-01T12:00', '2020-01-01T12:30'], dtype='datetime64[ns]')
+    return xr.DataArray(np.stack([packed, np.roll(packed, 3, axis=1)]),
+                        coords={'time': times, 'lat': dat.lat.values, 'lon': dat.lon.values},
+                        dims=['time', 'lat', 'lon'])
+
+
+@pytest.mark.parametrize('scale_factor', [False, True])
+def test_lazy_matches_stack_packed(scale_factor):
+    stack = _packed_stack()
+    wl = cores.dataset('METEOSAT5K_vera')
+    read_kwargs = dict(t_scale=0.01)
+    eager = wl.process_stack(stack, read_kwargs=read_kwargs, save_kwargs=dict(scale_factor=scale_factor))
+    lazy = wl.process_lazy(stack.chunk({'time': 1}), read_kwargs=read_kwargs, scale_factor=scale_factor).compute()
+
+    for var in ['power', 'tir']:
+        assert lazy[var].dtype == eager[var].dtype
+        np.testing.assert_array_equal(lazy[var].values, eager[var].values)
+    sfactor, dtype = (100, np.int16) if scale_factor else (1, np.int8)
+    np.testing.assert_array_equal(lazy['tir'].values, (np.round(stack.values * 0.01, 2) * sfactor).astype(dtype))
+
+
+def test_lazy_keep_original():
+    stack = _packed_stack()
+    wl = cores.dataset('METEOSAT5K_vera')
+    read_kwargs = dict(t_scale=0.01, keep_original=False)
+    eager = wl.process_stack(stack, read_kwargs=read_kwargs)
+    lazy = wl.process_lazy(stack.chunk({'time': 1}), read_kwargs=read_kwargs).compute()
+
+    assert 'tir' not in eager
+    assert 'tir' not in lazy
+    np.testing.assert_array_equal(lazy['power'].values, eager['power'].values)
@@ -0,0 +1,66 @@
+import numpy as np
+import pytest
+import xarray as xr
+
+from ccores import constants, cores, ioUtils, trackUtils
+
+
+def _stack(nt=4):
+    """
+    Time slots of the test data, shifted by 3 pixels to the east per 30 minutes.
+    """
+    dat = xr.open_dataarray(constants.TESTDATA).squeeze()
+    dat = dat.sel(lat=slice(4, 12), lon=slice(13, 24)) / 100
+    times = np.datetime64('2020-01-01T12:00', 'ns') + np.arange(nt) * np.timedelta64(30, 'm')
+    return xr.DataArray(np.stack([np.roll(dat.values, 3 * tt, axis=1) for tt in range(nt)]),
+                        coords={'time': times, 'lat': dat.lat.values, 'lon': dat.lon.values},
+                        dims=['time', 'lat', 'lon'], name='tir')
+
+
+@pytest.fixture(scope='module')
+def files(tmp_path_factory):
+    stack = _stack()
+    paths = []
+    for ids in range(2):
+        path = str(tmp_path_factory.mktemp('slots') / ('slots_%d.nc' % ids))
+        stack.isel(time=slice(2 * ids, 2 * ids + 2)).to_netcdf(path)
+        paths.append(path)
+    return paths
+
+
+@pytest.mark.parametrize('batch_size', [1, 3])
+def test_stack_from_files(files, batch_size, monkeypatch):
+    opened = []
+    open_tir = ioUtils.open_tir
+
+    def counted(path, **kwargs):
+        opened.append(path)
+        return open_tir(path, **kwargs)
+
+    monkeypatch.setattr(ioUtils, 'open_tir', counted)
+    wl = cores.dataset('METEOSAT5K_vera')
+    expected = wl.process_stack(_stack())
+    out = wl.process_stack(files, batch_size=batch_size)
+
+    assert opened == files  # each file opened once
+    assert len(cores._files) == 0  # and closed
+    np.testing.assert_array_equal(out['time'].values, expected['time'].values)
+    for var in ['power', 'tir']:
+        np.testing.assert_array_equal(out[var].values, expected[var].values)
+
+
+@pytest.mark.parametrize('batch_size', [1, 2])
+def test_stack_tracking_in_workers(batch_size):
+    stack = _stack()
+    wl = cores.dataset('METEOSAT5K_vera')
+    serial = trackUtils.tracker()
+    expected = wl.process_stack(stack, tracker=serial)
+    parallel = trackUtils.tracker()
+    out = wl.process_stack(stack, tracker=parallel, n_workers=2, batch_size=batch_size)
+
+    np.testing.assert_array_equal(out['power'].values, expected['power'].values)
+    table, reference = parallel.table(), serial.table()
+    assert list(table) == list(reference)
+    for col in reference:
+        np.testing.assert_array_equal(table[col], reference[col])
+    assert np.all(reference['age'][reference['time'] == reference['time'].max()] > 1)  # cores followed over time
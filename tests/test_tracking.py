@@ -0,0 +1,72 @@
+import numpy as np
+import xarray as xr
+
+from ccores import constants, cores, trackUtils
+
+T0 = np.datetime64('2020-01-01T12:00')
+DT = np.timedelta64(30, 'm')
+
+
+def _table(centres):
+    y, x = np.array(centres).T
+    return dict(y=y, x=x, lat=np.zeros(len(y)), lon=np.zeros(len(y)))
+
+
+def _mask(centres, shape=(100, 100), half=5):
+    mask = np.zeros(shape)
+    for y, x in centres:
+        mask[y - half:y + half, x - half:x + half] = 1
+    return mask
+
+
+def test_tracker_synthetic():
+    tr = trackUtils.tracker(res=5., max_speed=10.)
+    first = [(15, 15), (45, 65)]
+    second = [(15, 19), (45, 69), (80, 10)]  # 4 pixels (20 km) east in 30 minutes, and a new core
+    third = [(15, 23), (45, 73), (80, 10)]
+
+    tr.update(T0, _table(first), mask=_mask(first))
+    out = tr.update(T0 + DT, _table(second), mask=_mask(second))
+    np.testing.assert_array_equal(out['track'], [0, 1, 2])
+    np.testing.assert_array_equal(out['age'], [2, 2, 1])
+    np.testing.assert_allclose(out['u'][:2], 20000. / 1800.)
+    np.testing.assert_allclose(out['v'][:2], 0.)
+    assert np.isnan(out['speed'][2])
+
+    # no mask: linked by distance to the positions predicted from the last velocity (faster than max_speed)
+    out = tr.update(T0 + 2 * DT, _table(third))
+    np.testing.assert_array_equal(out['track'], [0, 1, 2])
+    np.testing.assert_allclose(out['speed'][:2], 20000. / 1800.)
+
+    summary = tr.summary()
+    np.testing.assert_array_equal(summary['slots'], [3, 3, 2])
+    np.testing.assert_allclose(summary['lifetime'], [1., 1., 0.5])
+
+
+def test_tracker_shifted_slots():
+    dat = xr.open_dataarray(constants.TESTDATA).squeeze()
+    dat = dat.sel(lat=slice(4, 12), lon=slice(13, 24)) / 100
+    obj = cores.dataset('METEOSAT5K_vera')
+    tr = trackUtils.tracker()
+
+    tables = []
+    for ids, shift in enumerate([0, 3]):
+        obj.read_img(np.roll(dat.values, shift, axis=1), dat.lon.values, dat.lat.values)
+        obj.applyWavelet()
+        obj.scaleWeighting(wtype='sum', core_table=True)
+        tables.append(tr.update_from(obj, T0 + ids * DT))
+    first, second = tables
+
+    # every core of the first slot continues, 3 pixels further east
+    linked = second['age'] == 2
+    assert linked.sum() == len(first['track'])
+    order = np.argsort(first['track'])
+    prev = order[np.searchsorted(first['track'][order], second['track'][linked])]
+    np.testing.assert_array_equal(second['y'][linked], first['y'][prev])
+    np.testing.assert_array_equal(second['x'][linked], first['x'][prev] + 3)
+
+    dlon = 3 * (dat.lon.values[1] - dat.lon.values[0])
+    lat = np.radians(second['lat'][linked])
+    expected = np.radians(dlon) * trackUtils.EARTH_RADIUS * np.cos(lat) * 1000. / 1800.
+    np.testing.assert_allclose(second['u'][linked], expected, rtol=1e-6)
+    np.testing.assert_allclose(second['v'][linked], 0., atol=1e-9)
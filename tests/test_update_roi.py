@@ -0,0 +1,40 @@
+import numpy as np
+import pytest
+import xarray as xr
+
+from ccores import constants, cores
+
+# bounding box (rows, columns) of a storm in the interior of the test sub-domain
+ROWS = slice(121, 135)
+COLS = slice(227, 245)
+
+
+@pytest.mark.parametrize('preset', ['METEOSAT5K_vera', 'METEOSAT5K_veraLS'])
+def test_update_roi_matches_full_scene(preset):
+    dat = xr.open_dataarray(constants.TESTDATA).squeeze()
+    dat = dat.sel(lat=slice(4, 12), lon=slice(13, 24)) / 100
+    lon, lat = dat.lon.values, dat.lat.values
+    new = dat.values.copy()
+    old = new.copy()
+    old[ROWS, COLS] = 20.  # the storm is not there yet in the previous slot
+
+    full = cores.dataset(preset)
+    full.read_img(new.copy(), lon, lat)
+    full.applyWavelet()
+    expected = full.scaleWeighting(wtype='sum')
+
+    obj = cores.dataset(preset)
+    obj.read_img(old.copy(), lon, lat)
+    obj.applyWavelet()
+    previous = obj.scaleWeighting(wtype='sum').copy()
+
+    box = (lon[COLS.start], lon[COLS.stop - 1], lat[ROWS.start], lat[ROWS.stop - 1])
+    merged = obj.update_roi(new.copy(), lon, lat, box, wtype='sum')
+    inside = obj.updated
+
+    assert inside[ROWS, COLS].any()
+    assert np.any(merged[inside] < 0)  # the new storm has a core
+    np.testing.assert_array_equal(merged[inside] != 0, expected[inside] != 0)
+    np.testing.assert_array_equal(merged[inside] < 0, expected[inside] < 0)
+    np.testing.assert_allclose(merged[inside], expected[inside], rtol=1e-6, atol=1e-6)
+    np.testing.assert_array_equal(merged[~inside], previous[~inside])
@@ -0,0 +1,17 @@
+import numpy as np
+import pytest
+
+from ccores import wav
+
+
+@pytest.mark.parametrize('dtype', [np.float32, np.float64])
+@pytest.mark.parametrize('shape', [(298, 408), (450, 1558), (7, 3)])
+def test_std_matches_numpy(dtype, shape):
+    rng = np.random.default_rng(0)
+    arr = (rng.gamma(0.5, 40., size=shape) + 1e3).astype(dtype)  # skewed, large offset like wavelet power
+    tmp = np.empty_like(arr)
+
+    out = wav.std(arr, tmp)
+    assert out.dtype == np.std(arr).dtype
+    assert out == np.std(arr)
+    assert wav.std(arr) == np.std(arr)
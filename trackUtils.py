@@ -0,0 +1,289 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+from scipy.ndimage import label
+from scipy.spatial import cKDTree
+
+
+EARTH_RADIUS = 6371.  # km
+
+# columns tracker.update adds to the core table of a time slot
+TRACK_COLUMNS = ['time', 'track', 'age', 'lifetime', 'speed', 'u', 'v']
+
+
+class tracker(object):
+
+    def __init__(self, max_speed=30., min_overlap=1, res=None):
+        """
+        Incremental tracking of convective cores through consecutive time slots (see cores.dataset.process_stack(
+        tracker=...) or update_from). The cores of each new slot (core table of scaleWeighting(core_table=True)) are
+        linked to the cores of the previous slot in two steps:
+        1. overlap: cores whose core areas (connected non-zero areas of the filtered power) overlap with the core
+           areas of the previous slot, largest overlap first, then nearest centre
+        2. nearest neighbour: remaining cores are linked to the closest remaining core of the previous slot within
+           max_speed, using a KD-tree of the previous centres shifted by their last propagation velocity
+        Overlaps are counted on the core pixels of the previous slot only and distances are searched in the KD-tree,
+        so that the cost of a slot grows with the number of cores rather than the image size. Linked cores continue
+        the track of the previous core, all other cores start new tracks.
+        :param max_speed: maximum propagation speed in m/s for nearest neighbour links (default: 30)
+        :param min_overlap: minimum number of overlapping pixels for overlap links (default: 1)
+        :param res: optional pixel resolution in km. If given, distances are computed from pixel positions (y, x)
+                    instead of lat / lon in degrees.
+        """
+        self.max_speed = max_speed
+        self.min_overlap = min_overlap
+        self.res = res
+        self.ntracks = 0
+        self.slots = []
+        self._prev = None
+
+
+
+    def update(self, date, table, mask=None, labels=None):
+        """
+        Links the cores of a new time slot to the cores of the previous slot.
+        :param date: time of the slot (numpy.datetime64 or datetime.datetime), later than the previous slot
+        :param table: core table of the slot (dictionary of 1d arrays with at least y, x, lat, lon, see
+                      powerUtils.CORE_TABLE_COLUMNS), None if the slot has no cores
+        :param mask: optional core mask of the slot, e.g. scale_weighted power (non-zero for core pixels). Connected
+                     areas of the mask are the core areas used for overlap links.
+        :param labels: optional label image of the core areas (positive integers), instead of mask
+                       Without mask and labels, cores are linked by distance only.
+        :return: core table with the added columns TRACK_COLUMNS: time, track id, age (number of slots the track
+                 exists), lifetime (hours since the first slot of the track), speed (m/s) and velocity components
+                 u, v (m/s, eastward / northward, or along x / y with res). Speeds are NaN in the first slot of a track.
+        """
+        date = np.datetime64(date, 's')
+        table = {key: np.asarray(val) for key, val in (table or {}).items()}
+        for key in ['y', 'x', 'lat', 'lon']:
+            table.setdefault(key, np.zeros(0, dtype=int))
+        n = len(table['y'])
+
+        if (mask is not None) and (labels is None):
+            mask = np.asarray(mask) != 0
+            if mask.ndim > 2:
+                mask = np.any(mask, axis=tuple(range(mask.ndim - 2)))
+            labels, _ = label(mask)
+        regions = (labels[table['y'], table['x']] if labels is not None else np.zeros(n, dtype=int))
+
+        prev = self._prev
+        dt = None
+        if prev is not None:
+            dt = (date - prev['time']) / np.timedelta64(1, 's')
+            if dt <= 0:
+                print('Time slot', date, 'is not later than the previous slot, tracks restarted.')
+                prev, dt = None, None
+
+        link = np.full(n, -1)
+        if (prev is not None) and (n > 0) and (len(prev['track']) > 0):
+            link = self._link(table, regions, labels, prev, dt)
+
+        out = dict(table)
+        track = np.empty(n, dtype=int)
+        start = np.empty(n, dtype='datetime64[s]')
+        age = np.ones(n, dtype=int)
+        u = np.full(n, np.nan)
+        v = np.full(n, np.nan)
+
+        new = link < 0
+        track[new] = self.ntracks + np.arange(new.sum())
+        self.ntracks += int(new.sum())
+        start[new] = date
+
+        old = ~new
+        if old.any():
+            ids = link[old]
+            track[old] = prev['track'][ids]
+            start[old] = prev['start'][ids]
+            age[old] = prev['age'][ids] + 1
+            dx, dy = self._displacement(prev, ids, table, old)
+            u[old] = dx * 1000. / dt
+            v[old] = dy * 1000. / dt
+
+        out['time'] = np.full(n, date)
+        out['track'] = track
+        out['age'] = age
+        out['lifetime'] = (date - start) / np.timedelta64(1, 'h')
+        out['speed'] = np.hypot(u, v)
+        out['u'] = u
+        out['v'] = v
+        self.slots.append(out)
+
+        pix = np.flatnonzero(labels) if labels is not None else None
+        self._prev = dict(time=date, track=track, start=start, age=age, u=u, v=v, regions=regions,
+                          y=table['y'], x=table['x'], lat=table['lat'], lon=table['lon'],
+                          pix=pix, pix_regions=labels.flat[pix] if pix is not None else None,
+                          shape=labels.shape if labels is not None else None)
+        return out
+
+
+
+    def update_from(self, coreObj, date):
+        """
+        update with the core table and filtered power of a cores.dataset after scaleWeighting(core_table=True)
+        :param coreObj: cores.dataset
+        :param date: time of the slot
+        :return: core table with track columns, see update
+        """
+        return self.update(date, coreObj.core_table, mask=coreObj.scale_weighted)
+
+
+
+    def table(self):
+        """
+        All tracked cores of all slots so far.
+        :return: columnar table (dictionary of 1d arrays) with core table and track columns, ordered by time
+        """
+        if len(self.slots) == 0:
+            return {}
+        keys = [key for key in self.slots[0] if all(key in slot for slot in self.slots)]
+        return {key: np.concatenate([slot[key] for slot in self.slots]) for key in keys}
+
+
+
+    def summary(self):
+        """
+        Lifetime and propagation of all tracks so far.
+        :return: columnar table (dictionary of 1d arrays) with one row per track: track, start, end, lifetime
+                 (hours), slots (number of slots), speed (mean speed in m/s, NaN for single slot tracks), and the
+                 maximum area and minimum tmin over the track if in the core tables
+        """
+        tab = self.table()
+        if len(tab) == 0 or len(tab['track']) == 0:
+            return {}
+        order = np.argsort(tab['track'], kind='stable')
+        track, first, count = np.unique(tab['track'][order], return_index=True, return_counts=True)
+        last = first + count - 1
+
+        out = dict(track=track)
+        out['start'] = tab['time'][order][first]
+        out['end'] = tab['time'][order][last]
+        out['lifetime'] = tab['lifetime'][order][last]
+        out['slots'] = count
+        speed = tab['speed'][order]
+        valid = np.isfinite(speed)
+        nvalid = np.add.reduceat(valid.astype(int), first)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            out['speed'] = np.add.reduceat(np.where(valid, speed, 0), first) / nvalid
+        if 'area' in tab:
+            out['area'] = np.maximum.reduceat(tab['area'][order], first)
+        if 'tmin' in tab:
+            out['tmin'] = np.minimum.reduceat(tab['tmin'][order], first)
+        return out
+
+
+
+    def clear(self):
+        """
+        Removes all tracks and slots.
+        """
+        self.ntracks = 0
+        self.slots = []
+        self._prev = None
+
+
+
+    def _link(self, table, regions, labels, prev, dt):
+        """
+        Index of the linked core of the previous slot for each core of the new slot (-1: not linked).
+        """
+        n = len(table['y'])
+        npr = len(prev['track'])
+        pos = self._position(table['y'], table['x'], table['lat'], table['lon'])
+        pred = self._position(*self._predict(prev, dt))
+        link = np.full(n, -1)
+        taken = np.zeros(npr, dtype=bool)
+
+        # 1. overlap of the previous core areas with the new core areas
+        if (labels is not None) and (prev['pix'] is not None) and (labels.shape == prev['shape']):
+            if len(prev['pix']):
+                cur = labels.flat[prev['pix']]
+                valid = cur > 0
+                nreg = int(labels.max()) + 1
+                pairs, counts = np.unique(prev['pix_regions'][valid].astype(np.int64) * nreg + cur[valid],
+                                          return_counts=True)
+                keep = counts >= self.min_overlap
+                rprev, rcur = np.divmod(pairs[keep], nreg)
+
+                pcores = _groups(prev['regions'])
+                ccores = _groups(regions)
+                cand = []
+                for rp, rc, count in zip(rprev, rcur, counts[keep]):
+                    for i in pcores.get(rp, ()):
+                        for j in ccores.get(rc, ()):
+                            cand.append((-count, np.sum((pos[j] - pred[i]) ** 2), i, j))
+                for count, dist, i, j in sorted(cand):
+                    if (link[j] < 0) and not taken[i]:
+                        link[j] = i
+                        taken[i] = True
+
+        # 2. nearest neighbours within max_speed
+        free = np.flatnonzero(~taken)
+        todo = np.flatnonzero(link < 0)
+        if len(free) and len(todo):
+            maxdist = self.max_speed * dt / 1000.
+            if self.res is None:
+                maxdist = 2 * EARTH_RADIUS * np.sin(min(maxdist / (2 * EARTH_RADIUS), np.pi / 2))  # chord length
+            tree = cKDTree(pred[free])
+            k = min(len(free), 4)
+            dist, ind = tree.query(pos[todo], k=k, distance_upper_bound=maxdist)
+            dist, ind = dist.reshape(len(todo), k), ind.reshape(len(todo), k)
+            hit = np.isfinite(dist)
+            cand = sorted(zip(dist[hit], free[ind[hit]], np.repeat(todo, k).reshape(len(todo), k)[hit]))
+            for dist, i, j in cand:
+                if (link[j] < 0) and not taken[i]:
+                    link[j] = i
+                    taken[i] = True
+
+        return link
+
+
+
+    def _position(self, y, x, lat, lon):
+        """
+        Cartesian positions in km for the KD-tree: pixel positions times res, or points on the sphere from lat / lon.
+        """
+        if self.res is not None:
+            return np.column_stack([np.asarray(y, dtype=float) * self.res, np.asarray(x, dtype=float) * self.res])
+        lat, lon = np.radians(lat), np.radians(lon)
+        return EARTH_RADIUS * np.column_stack([np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)])
+
+
+
+    def _predict(self, prev, dt):
+        """
+        Centres of the previous cores moved with their last velocity over dt seconds (unmoved for new tracks).
+        """
+        u = np.nan_to_num(prev['u']) * dt / 1000.
+        v = np.nan_to_num(prev['v']) * dt / 1000.
+        if self.res is not None:
+            return prev['y'] + v / self.res, prev['x'] + u / self.res, prev['lat'], prev['lon']
+        km = np.radians(1.) * EARTH_RADIUS  # km per degree latitude
+        lat = prev['lat'] + v / km
+        lon = prev['lon'] + u / (km * np.maximum(np.cos(np.radians(prev['lat'])), 1e-6))
+        return prev['y'], prev['x'], lat, lon
+
+
+
+    def _displacement(self, prev, ids, table, sel):
+        """
+        Eastward and northward (or x and y with res) displacement in km from the linked previous cores.
+        """
+        if self.res is not None:
+            return ((table['x'][sel] - prev['x'][ids]) * self.res,
+                    (table['y'][sel] - prev['y'][ids]) * self.res)
+        km = np.radians(1.) * EARTH_RADIUS
+        dlon = (table['lon'][sel] - prev['lon'][ids] + 180.) % 360. - 180.
+        lat = np.radians((table['lat'][sel] + prev['lat'][ids]) / 2.)
+        return dlon * km * np.cos(lat), (table['lat'][sel] - prev['lat'][ids]) * km
+
+
+
+def _groups(regions):
+    """
+    Core indices per region label (regions > 0).
+    """
+    out = {}
+    for ids, reg in enumerate(regions):
+        if reg > 0:
+            out.setdefault(reg, []).append(ids)
+    return out
@@ -22,10 +22,31 @@ REFERENCES
 __version__ = '$Revision: 1 $'
 # $Source$
 
-from numpy import (arange, ceil, concatenate, conjugate, cos, exp, floor, 
-                   isnan, log, log2, meshgrid, ones, pi, prod, real, sqrt,
+from numpy import (arange, ceil, concatenate, conjugate, cos, empty_like, exp, floor, 
+                   isnan, log, log2, meshgrid, multiply, ones, pi, prod, real, sqrt,
                    zeros, polyval)
-from numpy.fft import ifft2, fftfreq, fft2
+from numpy import dtype as dtype_of
+from numpy import pad as np_pad
+from numpy import fft as numpy_fft
+from numpy.fft import fftfreq, rfftfreq
+from collections import OrderedDict
+from threading import Lock
+import os
+import pickle
+from concurrent.futures import ThreadPoolExecutor
+from scipy.ndimage import convolve1d
+from ccores import perfUtils
+
+try:
+    from scipy import fft as scipy_fft
+except ImportError:
+    scipy_fft = None
+
+try:
+    import pyfftw
+    import pyfftw.interfaces.numpy_fft as fftw_fft
+except ImportError:
+    pyfftw = None
 
 
 class Mexican_hat():
@@ -50,13 +71,337 @@ class Mexican_hat():
         """Mexican hat wavelet as in Wang and Lu (2010), equation [14]."""
         X, Y = meshgrid(x, y)
         return (2. - (X ** 2. + Y ** 2.)) * exp(-0.5 * (X ** 2. + Y ** 2.))
+
+    def psi_ft_separable(self, k, l):
+        """
+        Separable form of psi_ft: pairs of 1d (k, l) factors whose outer
+        products sum up to psi_ft(k, l), i.e.
+        (k**2 + l**2) exp(-(k**2 + l**2) / 2) =
+            k**2 exp(-k**2 / 2) * exp(-l**2 / 2) +
+            exp(-k**2 / 2) * l**2 exp(-l**2 / 2)
+        """
+        gk, gl = exp(-0.5 * k ** 2.), exp(-0.5 * l ** 2.)
+        return [(k ** 2. * gk, gl), (gk, l ** 2. * gl)]
         
     def flambda(self):
         """Fourier wavelength as of Torrence and Compo (1998)."""
         return (2 * pi / sqrt(2.5))
 
 
-def cwt2d(f, dx, dy, dj=1./12, s0=-1, J=-1, wavelet=Mexican_hat()):
+def wavenumbers(N, M, dx, dy, rfft=False):
+    """
+    Zonal (k) and meridional (l) wave numbers of an N x M FFT grid, k only
+    covers the half spectrum if rfft is True.
+    """
+    if rfft:
+        return 2 * pi * rfftfreq(M, dx), 2 * pi * fftfreq(N, dy)
+    return 2 * pi * fftfreq(M, dx), 2 * pi * fftfreq(N, dy)
+
+
+class FilterBank():
+    """
+    Spectral wavelet kernels for a fixed (padded) grid and a fixed set of
+    scales. The kernels only depend on the grid shape, the sample spacing,
+    the scales and the mother wavelet, so they can be computed once and be
+    reused for every image on the same grid.
+    If rfft is True, the kernels only cover the half spectrum along the last
+    axis as used by rfft2/irfft2. dtype sets the precision of the kernels
+    (float64 or float32).
+    """
+
+    def __init__(self, N, M, dx, dy, a, wavelet=Mexican_hat(), rfft=False, dtype='float64'):
+        self.shape = (N, M)
+        self.dx = dx
+        self.dy = dy
+        self.scales = a
+        self.wavelet = wavelet
+        self.rfft = rfft
+        k, l = wavenumbers(N, M, dx, dy, rfft=rfft)
+        self.kernels = zeros((len(a), N, len(k)), dtype=dtype)
+        for i, an in enumerate(a):
+            self.kernels[i, :, :] = an * wavelet.psi_ft(an * k, an * l)
+
+    @property
+    def nbytes(self):
+        return self.kernels.nbytes
+
+
+# Bounded LRU cache of filter banks. A bank is evicted once more than
+# FILTER_CACHE_SIZE banks are held or their kernels exceed FILTER_CACHE_BYTES
+# in total. The most recently used bank is always kept.
+FILTER_CACHE_SIZE = 4
+FILTER_CACHE_BYTES = 2 * 1024 ** 3
+
+_filter_cache = OrderedDict()
+_filter_lock = Lock()
+
+
+def _filter_key(N, M, dx, dy, a, wavelet, rfft, dtype):
+    return (N, M, float(dx), float(dy), tuple(float(an) for an in a),
+            type(wavelet), wavelet.name, bool(rfft), dtype_of(dtype).str)
+
+
+def filter_bank(N, M, dx, dy, a, wavelet=Mexican_hat(), rfft=False, dtype='float64'):
+    """
+    Returns the cached FilterBank for the given grid, scales and wavelet,
+    computing (and caching) it on first use.
+    """
+    key = _filter_key(N, M, dx, dy, a, wavelet, rfft, dtype)
+    with _filter_lock:
+        bank = _filter_cache.get(key)
+        if bank is not None:
+            _filter_cache.move_to_end(key)
+            return bank
+
+    bank = FilterBank(N, M, dx, dy, a, wavelet=wavelet, rfft=rfft, dtype=dtype)
+
+    with _filter_lock:
+        _filter_cache[key] = bank
+        _filter_cache.move_to_end(key)
+        while len(_filter_cache) > 1 and (
+                len(_filter_cache) > FILTER_CACHE_SIZE or
+                sum(b.nbytes for b in _filter_cache.values()) > FILTER_CACHE_BYTES):
+            _filter_cache.popitem(last=False)
+    return bank
+
+
+def clear_filter_cache():
+    """Drops all cached filter banks."""
+    with _filter_lock:
+        _filter_cache.clear()
+
+
+class FFTBackend():
+    """
+    Selects the FFT implementation used by cwt2d.
+    PARAMETERS
+        name (str, optional) :
+            'numpy' (default, single threaded), 'scipy' (scipy.fft, threaded
+            via workers) or 'pyfftw' (FFTW through pyfftw, if installed).
+        workers (int, optional) :
+            Number of threads for 'scipy' and 'pyfftw'. -1 uses all cores.
+            Default is None (library default, single threaded).
+        plan_cache (bool, optional) :
+            pyfftw only: keep FFTW plans alive between calls so that
+            repeated transforms of the same shape skip planning.
+        planner_effort (str, optional) :
+            pyfftw only: FFTW planner flag, e.g. 'FFTW_ESTIMATE' (default)
+            or 'FFTW_MEASURE'. Wisdom gathered while planning is kept in the
+            process and can be saved/loaded with save_wisdom/load_wisdom.
+        wisdom (str, optional) :
+            pyfftw only: path of a wisdom file written by save_wisdom that is
+            loaded on initialisation.
+    """
+
+    def __init__(self, name='numpy', workers=None, plan_cache=True, planner_effort='FFTW_ESTIMATE', wisdom=None):
+
+        if name not in ['numpy', 'scipy', 'pyfftw']:
+            raise ValueError('FFT backend not found. Choose one of "numpy", "scipy", "pyfftw"')
+        if (name == 'scipy') & (scipy_fft is None):
+            raise ImportError('scipy.fft is not available, please install scipy >= 1.4')
+        if (name == 'pyfftw') & (pyfftw is None):
+            raise ImportError('pyfftw is not installed')
+
+        self.name = name
+        self.workers = workers
+        self.plan_cache = plan_cache
+        self.planner_effort = planner_effort
+
+        if name == 'pyfftw':
+            if plan_cache:
+                pyfftw.interfaces.cache.enable()
+                pyfftw.interfaces.cache.set_keepalive_time(60)
+            else:
+                pyfftw.interfaces.cache.disable()
+            if wisdom:
+                self.load_wisdom(wisdom)
+
+    def _kwargs(self):
+        if self.name == 'scipy':
+            return {'workers': self.workers}
+        if self.name == 'pyfftw':
+            threads = self.workers
+            if (threads is None):
+                threads = 1
+            elif threads < 0:
+                threads = os.cpu_count()
+            return {'threads': threads, 'planner_effort': self.planner_effort}
+        return {}
+
+    def _module(self):
+        if self.name == 'scipy':
+            return scipy_fft
+        if self.name == 'pyfftw':
+            return fftw_fft
+        return numpy_fft
+
+    def fft2(self, x, s=None):
+        return self._module().fft2(x, s=s, **self._kwargs())
+
+    def ifft2(self, x, s=None):
+        return self._module().ifft2(x, s=s, **self._kwargs())
+
+    def rfft2(self, x, s=None):
+        return self._module().rfft2(x, s=s, **self._kwargs())
+
+    def irfft2(self, x, s=None):
+        return self._module().irfft2(x, s=s, **self._kwargs())
+
+    def save_wisdom(self, path):
+        """Writes the FFTW wisdom accumulated in this process to path (pyfftw only)."""
+        if self.name != 'pyfftw':
+            return
+        with open(path, 'wb') as outf:
+            pickle.dump(pyfftw.export_wisdom(), outf)
+
+    def load_wisdom(self, path):
+        """Loads FFTW wisdom written by save_wisdom (pyfftw only)."""
+        if (self.name != 'pyfftw') | (not os.path.isfile(path)):
+            return
+        with open(path, 'rb') as inf:
+            pyfftw.import_wisdom(pickle.load(inf))
+
+
+# Backend used by cwt2d when no backend is passed explicitly.
+_fft_default = FFTBackend()
+
+
+def set_fft_backend(name='numpy', workers=None, **kwargs):
+    """
+    Sets the module default FFT backend for cwt2d. Accepts the same
+    arguments as FFTBackend and returns the new backend.
+    """
+    global _fft_default
+    _fft_default = FFTBackend(name, workers=workers, **kwargs)
+    return _fft_default
+
+
+def get_fft_backend(backend=None):
+    """Returns backend as FFTBackend: None gives the module default, a string a new backend of that name."""
+    if backend is None:
+        return _fft_default
+    if isinstance(backend, str):
+        return FFTBackend(backend)
+    return backend
+
+
+PAD_POLICIES = ['pow2', 'fast']
+PAD_MODES = ['constant', 'reflect', 'symmetric']
+
+
+def next_fast_len(n):
+    """Smallest 5-smooth length (2**p * 3**q * 5**r) >= n."""
+    if scipy_fft is not None:
+        return scipy_fft.next_fast_len(int(n), real=True)
+    best = 2 ** int(ceil(log2(n)))
+    p5 = 1
+    while p5 < best:
+        p35 = p5
+        while p35 < best:
+            quotient = -(-n // p35)
+            p2 = 2 ** int(ceil(log2(quotient))) if quotient > 1 else 1
+            best = min(best, p2 * p35)
+            p35 *= 3
+        p5 *= 5
+    return best
+
+
+def pad_shape(n0, m0, pad='pow2'):
+    """
+    Padded FFT grid size for an n0 x m0 image.
+    pad='pow2': next higher power of 2 on each axis (original behaviour)
+    pad='fast': next 5-smooth length on each axis (see next_fast_len)
+    """
+    if pad == 'pow2':
+        return 2 ** int(ceil(log2(n0))), 2 ** int(ceil(log2(m0)))
+    if pad == 'fast':
+        return next_fast_len(n0), next_fast_len(m0)
+    raise ValueError('Padding policy not found. Choose one of ' + str(PAD_POLICIES))
+
+
+ENGINES = ['fft', 'direct', 'auto']
+
+# Truncation radius of the spatial wavelet in the direct engine, in units of
+# the wavelet scale. The Mexican hat envelope exp(-r**2 / 2a**2) has dropped
+# to ~1e-4 of its peak at r = 5a, the direct coefficients then match the FFT
+# transform to within 5e-5 of the largest coefficient of each scale away
+# from the image borders for scales of 1.5 pixels and more (all datasets in
+# constants.NAMES, measured up to ~3.4e-5). A larger truncation does not
+# tighten this much, as scales close to the pixel size reach the band limit
+# of the grid, which gives the kernels slowly decaying tails (~5e-3 at 1
+# pixel).
+DIRECT_TRUNCATE = 5
+
+# Cost model of engine='auto', in units of one multiply-add of a 1d
+# convolution per pixel: a separable direct convolution costs
+# 4 * (DIRECT_PASS_OVERHEAD + kernel length) per image pixel, one inverse
+# FFT FFT_COST * log2(N * M) per padded grid pixel. Measured with numpy.fft
+# and scipy.ndimage, faster FFT backends move the crossover to smaller
+# kernels.
+DIRECT_PASS_OVERHEAD = 12
+FFT_COST = 2.4
+
+_NDIMAGE_MODES = {'constant': 'constant', 'reflect': 'mirror', 'symmetric': 'reflect'}
+
+
+def direct_radius(an, dx, dy, truncate=DIRECT_TRUNCATE):
+    """Radius in pixels of the truncated spatial wavelet at scale an."""
+    return int(ceil(truncate * an / min(dx, dy)))
+
+
+def use_direct(an, n0, m0, N, M, dx, dy, truncate=DIRECT_TRUNCATE):
+    """
+    True if the direct convolution at scale an is estimated to be cheaper
+    than an inverse FFT on the padded N x M grid, see FFT_COST.
+    """
+    L = 2 * direct_radius(an, dx, dy, truncate) + 1
+    return 4 * (DIRECT_PASS_OVERHEAD + L) * n0 * m0 < FFT_COST * log2(N * M) * N * M
+
+
+def direct_kernels(an, dx, dy, grid, wavelet=Mexican_hat(), truncate=DIRECT_TRUNCATE):
+    """
+    Truncated spatial kernels of the wavelet at scale an: pairs of 1d (x, y)
+    kernels whose separable convolutions sum up to the FFT transform of
+    cwt2d on the N x M grid. The kernels are the inverse 1d transforms of
+    the factors of wavelet.psi_ft_separable, so that they carry the same
+    normalisation and band limit as the spectral kernel an * psi_ft(an * k,
+    an * l) even for scales close to the pixel size, where the sampled
+    spatial wavelet psi would not.
+    """
+    N, M = grid
+    R = min(direct_radius(an, dx, dy, truncate), (N - 1) // 2, (M - 1) // 2)
+    k, l = wavenumbers(N, M, dx, dy)
+    taps = arange(-R, R + 1)
+    pairs = []
+    for fk, fl in wavelet.psi_ft_separable(an * k, an * l):
+        pairs.append((an * real(numpy_fft.ifft(fk)).take(taps, mode='wrap'),
+                      real(numpy_fft.ifft(fl)).take(taps, mode='wrap')))
+    return pairs
+
+
+def convolve_direct(f, an, dx, dy, wavelet=Mexican_hat(), truncate=DIRECT_TRUNCATE, pad_mode='constant',
+                    grid=None):
+    """
+    Wavelet coefficients of f at the single scale an by direct, separable
+    convolution with the truncated spatial wavelet (see direct_kernels).
+    grid is the (N, M) FFT grid the result is to match, f.shape by default.
+    pad_mode gives the treatment of the image borders as in cwt2d.
+    """
+    mode = _NDIMAGE_MODES[pad_mode]
+    out = None
+    for kx, ky in direct_kernels(an, dx, dy, grid or f.shape, wavelet=wavelet, truncate=truncate):
+        part = convolve1d(convolve1d(f, kx.astype(f.dtype), axis=1, mode=mode), ky.astype(f.dtype), axis=0,
+                          mode=mode)
+        if out is None:
+            out = part
+        else:
+            out += part
+    return out
+
+
+def cwt2d(f, dx, dy, dj=1./12, s0=-1, J=-1, wavelet=Mexican_hat(), cache=True,
+          rfft=False, backend=None, pad='pow2', pad_mode='constant', dtype='float64',
+          engine='fft', truncate=DIRECT_TRUNCATE, profiler=None, out=None):
     """
     Bi-dimensional continuous wavelet transform of the signal at 
     specified scale a.
@@ -79,10 +424,55 @@ def cwt2d(f, dx, dy, dj=1./12, s0=-1, J=-1, wavelet=Mexican_hat()):
             Scale parameter array.
         wavelet (class, optional) :
             Mother wavelet class. Default is Mexican_hat()
+        cache (bool, optional) :
+            If True (default), the spectral kernels are taken from the
+            bounded filter bank cache (see filter_bank) and are only built
+            once per grid shape, sample spacing, scales and wavelet.
+        rfft (bool, optional) :
+            If True, uses real-to-real transforms (rfft2/irfft2) on the
+            half spectrum and returns real coefficients of the unpadded
+            size. Only valid for real input and a real, symmetric mother
+            wavelet such as the Mexican hat. Default is False.
+        backend (FFTBackend or str, optional) :
+            FFT implementation, see FFTBackend. Default is the module
+            backend set by set_fft_backend (numpy unless changed).
+        pad (str, optional) :
+            FFT grid padding policy: 'pow2' pads each axis to the next
+            power of two (default), 'fast' to the next 5-smooth length,
+            which is usually much smaller, see pad_shape.
+        pad_mode (str, optional) :
+            How the padding is filled: 'constant' (default) appends zeros,
+            'reflect' and 'symmetric' mirror the image into the padding on
+            both sides (numpy.pad modes), which avoids the sharp image/zero
+            step at the edges and the wrap-around with small padding.
+        dtype (str or numpy dtype, optional) :
+            Working precision, 'float64' (default) or 'float32'. In single
+            precision the input, kernels and output are float32 (complex64
+            if rfft=False). Note that numpy.fft < 2.0 always computes in
+            double precision, the 'scipy' and 'pyfftw' backends compute in
+            single precision.
+        engine (str, optional) :
+            'fft' (default) computes every scale via the convolution
+            theorem. 'direct' convolves the image with the truncated spatial
+            wavelet instead (see convolve_direct), which is cheaper for
+            small scales with a small spatial footprint. 'auto' picks the
+            cheaper engine per scale (see use_direct). 'direct' and 'auto'
+            require rfft=True and a wavelet with a psi_ft_separable method.
+        truncate (float, optional) :
+            Truncation radius of the spatial wavelet of the direct engine in
+            units of the wavelet scale. Default is DIRECT_TRUNCATE.
+        profiler (object, optional) :
+            Instrumentation hook with a stage(name, **info) context manager
+            (ccores.perfUtils.profiler). Times the forward FFT and every
+            per-scale inverse transform.
+        out (array like, optional) :
+            rfft=True only: (J+1) x n x m array of dtype the coefficients
+            are written to (and returned), e.g. a buffer reused for every
+            image on the same grid.
     RETURNS
         Wf (array like) :
             2D wavelet transform according to the selected mother wavelet.
-            Has (J+1) x N x M dimensions.
+            Has (J+1) x N x M dimensions, complex or real if rfft=True.
         a (array like) :
             Vector of scale indices given by a = s0 * 2**(j * dj),
             j={0, 1, ..., J}.
@@ -93,25 +483,297 @@ def cwt2d(f, dx, dy, dj=1./12, s0=-1, J=-1, wavelet=Mexican_hat()):
         wave, scales, freqs = twod.cwt2d(var, 9., 9., 1./12, -1, -1)
     """
     #**************DB NOTE: new scales work ONLY for dx = dy!!!!!********************
-    # Determines the shape of the arrays and the discrete scales.
-
-    n0, m0 = f.shape
-    if s0 == -1: s0 = 2 * max(dx,dy) / wavelet.flambda()  # Smallest resolvable scale
-    if J == -1: J = int(log2(max(n0,m0) * max(dx,dy) / s0) / dj)  # Number of scales
-    N, M = 2 ** int(ceil(log2(n0))), 2 ** int(ceil(log2(m0)))   # Next higher power of 2
-    
-    a = s0 * 2. ** (arange(0, J+1) * dj)         # The scales
+    f, a, (n0, m0), (N, M), (y0, x0) = _setup(f, dx, dy, dj, s0, J, wavelet, pad, pad_mode, dtype)
     A = len(a)
-    # Calculates the zonal and meridional wave numbers.
-    l, k = 2 * pi * fftfreq(N, dy), 2 * pi * fftfreq(M, dx)
+    fft = get_fft_backend(backend)
+    # Spectral kernels for every discrete scale.
+    if cache:
+        bank = filter_bank(N, M, dx, dy, a, wavelet=wavelet, rfft=rfft, dtype=dtype)
+    else:
+        bank = FilterBank(N, M, dx, dy, a, wavelet=wavelet, rfft=rfft, dtype=dtype)
+
+    if rfft:
+        direct = _direct_scales(a, (n0, m0), (N, M), dx, dy, engine, truncate, wavelet)
+        # Half spectrum transform, the cropped coefficients are written
+        # straight into a real output array.
+        if not all(direct):
+            with perfUtils.stage(profiler, 'fft_forward', grid=(N, M), backend=fft.name):
+                f_ft = fft.rfft2(f, s=(N, M))
+            f_kernel = empty_like(f_ft)  # spectrum times kernel, reused for every scale
+        Wf = zeros((A, n0, m0), dtype=dtype) if out is None else out
+        for i in range(A):
+            with perfUtils.stage(profiler, 'fft_inverse', scale=i, engine='direct' if direct[i] else 'fft'):
+                if direct[i]:
+                    Wf[i, :, :] = convolve_direct(f[y0:y0 + n0, x0:x0 + m0], a[i], dx, dy, wavelet=wavelet,
+                                                  truncate=truncate, pad_mode=pad_mode, grid=(N, M))
+                else:
+                    multiply(f_ft, bank.kernels[i], out=f_kernel)
+                    Wf[i, :, :] = fft.irfft2(f_kernel, s=(N, M))[y0:y0 + n0, x0:x0 + m0]
+        return Wf
+
+    if out is not None:
+        raise ValueError('out requires rfft=True')
+    if engine != 'fft':
+        raise ValueError('engine "' + str(engine) + '" requires rfft=True')
+
     # Calculates the Fourier transform of the input signal.
-    f_ft = fft2(f, s=(N, M))
+    with perfUtils.stage(profiler, 'fft_forward', grid=(N, M), backend=fft.name):
+        f_ft = fft.fft2(f, s=(N, M))
     # Creates empty wavelet transform array and fills it for every discrete
     # scale using the convolution theorem.
-    Wf = zeros((A, N, M), 'complex')
+    Wf = zeros((A, N, M), (zeros(1, dtype=dtype) * 1j).dtype)
+    for i in range(A):
+        with perfUtils.stage(profiler, 'fft_inverse', scale=i, engine='fft'):
+            Wf[i, :, :] = fft.ifft2(f_ft * bank.kernels[i], s=(N, M))
+
+    return Wf[:, y0:y0 + n0, x0:x0 + m0]
+
+
+def _setup(f, dx, dy, dj, s0, J, wavelet, pad, pad_mode, dtype):
+    """
+    Determines the discrete scales and the padded grid of the transform and
+    casts the input to dtype and pads it for the mirrored padding modes. Returns the (padded)
+    input, the scales, the image shape, the padded shape and the offset of
+    the image within the padded grid. Images are the last two axes of f.
+    """
+    # Determines the shape of the arrays and the discrete scales.
+    f = f.astype(dtype, copy=False)
+    n0, m0 = f.shape[-2:]
+    if s0 == -1: s0 = 2 * max(dx,dy) / wavelet.flambda()  # Smallest resolvable scale
+    if J == -1: J = int(log2(max(n0,m0) * max(dx,dy) / s0) / dj)  # Number of scales
+    N, M = pad_shape(n0, m0, pad)   # Padded FFT grid size
+    if pad_mode not in PAD_MODES:
+        raise ValueError('Padding mode not found. Choose one of ' + str(PAD_MODES))
+    if pad_mode == 'constant':
+        y0, x0 = 0, 0  # zeros appended by the forward FFT
+    else:
+        y0, x0 = (N - n0) // 2, (M - m0) // 2
+        f = np_pad(f, ((0, 0),) * (f.ndim - 2) + ((y0, N - n0 - y0), (x0, M - m0 - x0)), mode=pad_mode)
+
+    a = s0 * 2. ** (arange(0, J+1) * dj)         # The scales
+
+    return f, a, (n0, m0), (N, M), (y0, x0)
+
+
+def _direct_scales(a, shape, padded_shape, dx, dy, engine, truncate, wavelet):
+    """Per-scale engine choice, True where a scale is transformed by direct convolution."""
+    if engine not in ENGINES:
+        raise ValueError('Engine not found. Choose one of ' + str(ENGINES))
+    if engine == 'fft':
+        return [False] * len(a)
+    if not hasattr(wavelet, 'psi_ft_separable'):
+        if engine == 'auto':
+            return [False] * len(a)
+        raise ValueError('The direct engine requires a separable wavelet (psi_ft_separable)')
+    if engine == 'direct':
+        return [True] * len(a)
+    return [use_direct(an, shape[0], shape[1], padded_shape[0], padded_shape[1], dx, dy, truncate) for an in a]
+
+
+def cwt2d_iter(f, dx, dy, dj=1./12, s0=-1, J=-1, wavelet=Mexican_hat(), cache=False,
+               backend=None, pad='pow2', pad_mode='constant', dtype='float64', engine='fft',
+               truncate=DIRECT_TRUNCATE, profiler=None):
+    """
+    Scale-by-scale version of cwt2d(rfft=True): yields the real (n x m)
+    wavelet coefficients of one scale at a time, from the smallest to the
+    largest scale, so that the (J+1) x n x m cube is never held in memory.
+    Takes the same parameters as cwt2d. By default (cache=False) the
+    spectral kernels are also built one scale at a time instead of taking a
+    full filter bank from the cache, which keeps the peak memory of a
+    complete iteration at a few n x m sized arrays. With engine='direct'
+    or 'auto', scales are convolved in the spatial domain as in cwt2d.
+    EXAMPLE
+        for i, wave in enumerate(twod.cwt2d_iter(var, 9., 9., 1./12, -1, -1)):
+            power_sum += wave ** 2
+    """
+    f, a, (n0, m0), (N, M), (y0, x0) = _setup(f, dx, dy, dj, s0, J, wavelet, pad, pad_mode, dtype)
+    fft = get_fft_backend(backend)
+    direct = _direct_scales(a, (n0, m0), (N, M), dx, dy, engine, truncate, wavelet)
+
+    if not all(direct):
+        if cache:
+            bank = filter_bank(N, M, dx, dy, a, wavelet=wavelet, rfft=True, dtype=dtype)
+        else:
+            k, l = wavenumbers(N, M, dx, dy, rfft=True)
+
+        with perfUtils.stage(profiler, 'fft_forward', grid=(N, M), backend=fft.name):
+            f_ft = fft.rfft2(f, s=(N, M))
+
     for i, an in enumerate(a):
-        psi_ft_bar = an * wavelet.psi_ft(an * k, an * l)
-        Wf[i, :, :] = ifft2(f_ft * psi_ft_bar, s=(N, M))
+        # the transform is timed without the consumer of the generator
+        with perfUtils.stage(profiler, 'fft_inverse', scale=i, engine='direct' if direct[i] else 'fft'):
+            if direct[i]:
+                wave = convolve_direct(f[y0:y0 + n0, x0:x0 + m0], an, dx, dy, wavelet=wavelet, truncate=truncate,
+                                       pad_mode=pad_mode, grid=(N, M))
+            else:
+                if cache:
+                    psi_ft_bar = bank.kernels[i]
+                else:
+                    psi_ft_bar = (an * wavelet.psi_ft(an * k, an * l)).astype(dtype, copy=False)
+                wave = fft.irfft2(f_ft * psi_ft_bar, s=(N, M))[y0:y0 + n0, x0:x0 + m0].astype(dtype, copy=False)
+        yield wave
+
+
+# Number of images transformed together by cwt2d_batch.
+BATCH_SIZE = 8
+
+
+def cwt2d_batch(f, dx, dy, dj=1./12, s0=-1, J=-1, wavelet=Mexican_hat(), cache=True,
+                rfft=False, backend=None, pad='pow2', pad_mode='constant', dtype='float64',
+                engine='fft', truncate=DIRECT_TRUNCATE, batch_size=BATCH_SIZE, profiler=None, out=None):
+    """
+    cwt2d of a stack of images on the same grid, e.g. the time slots of an
+    archive. The images of a batch are transformed together: one forward
+    FFT of the (B, N, M) batch and one inverse FFT per scale, with the
+    (cached) spectral kernels broadcast over the batch. Multi-threaded and
+    vectorised FFT backends ('scipy', 'pyfftw' with workers) get larger
+    transforms to work on, and the per-call overhead is paid once per
+    batch instead of once per image.
+    PARAMETERS
+        f (array like):
+            Input signal array, T x n x m.
+        dx, dy, dj, s0, J, wavelet, cache, rfft, backend, pad, pad_mode,
+        dtype, engine, truncate, profiler :
+            As in cwt2d. Scales using the direct engine are convolved image
+            by image.
+        batch_size (int, optional) :
+            Number of images transformed together. Caps the FFT work arrays
+            at batch_size x N x M (complex). Default is BATCH_SIZE.
+        out (array like, optional) :
+            rfft=True only: T x (J+1) x n x m output array, as in cwt2d.
+    RETURNS
+        Wf (array like) :
+            T x (J+1) x n x m wavelet coefficients, complex or real if
+            rfft=True. Wf[t] equals cwt2d(f[t], ...).
+    EXAMPLE
+        wave = twod.cwt2d_batch(stack, 9., 9., 1./12, -1, -1, rfft=True)
+    """
+    f, a, (n0, m0), (N, M), (y0, x0) = _setup(f, dx, dy, dj, s0, J, wavelet, pad, pad_mode, dtype)
+    T, A = f.shape[0], len(a)
+    fft = get_fft_backend(backend)
+    if cache:
+        bank = filter_bank(N, M, dx, dy, a, wavelet=wavelet, rfft=rfft, dtype=dtype)
+    else:
+        bank = FilterBank(N, M, dx, dy, a, wavelet=wavelet, rfft=rfft, dtype=dtype)
+
+    if rfft:
+        direct = _direct_scales(a, (n0, m0), (N, M), dx, dy, engine, truncate, wavelet)
+        Wf = zeros((T, A, n0, m0), dtype=dtype) if out is None else out
+    elif out is not None:
+        raise ValueError('out requires rfft=True')
+    elif engine != 'fft':
+        raise ValueError('engine "' + str(engine) + '" requires rfft=True')
+    else:
+        direct = [False] * A
+        Wf = zeros((T, A, n0, m0), (zeros(1, dtype=dtype) * 1j).dtype)
+
+    batch_size = max(int(batch_size), 1)
+    for t0 in range(0, T, batch_size):
+        fb = f[t0:t0 + batch_size]
+        t1 = t0 + fb.shape[0]
+        if not all(direct):
+            with perfUtils.stage(profiler, 'fft_forward', grid=(N, M), backend=fft.name, batch=fb.shape[0]):
+                f_ft = fft.rfft2(fb, s=(N, M)) if rfft else fft.fft2(fb, s=(N, M))
+        for i in range(A):
+            with perfUtils.stage(profiler, 'fft_inverse', scale=i, engine='direct' if direct[i] else 'fft',
+                        batch=fb.shape[0]):
+                if direct[i]:
+                    for t in range(fb.shape[0]):
+                        Wf[t0 + t, i, :, :] = convolve_direct(fb[t, y0:y0 + n0, x0:x0 + m0], a[i], dx, dy,
+                                                              wavelet=wavelet, truncate=truncate,
+                                                              pad_mode=pad_mode, grid=(N, M))
+                elif rfft:
+                    Wf[t0:t1, i, :, :] = fft.irfft2(f_ft * bank.kernels[i], s=(N, M))[:, y0:y0 + n0, x0:x0 + m0]
+                else:
+                    Wf[t0:t1, i, :, :] = fft.ifft2(f_ft * bank.kernels[i], s=(N, M))[:, y0:y0 + n0, x0:x0 + m0]
+
+    return Wf
+
+
+# Halo width of tiles in cwt2d_tiled in units of the largest wavelet scale,
+# see DIRECT_TRUNCATE for the decay of the Mexican hat envelope. A halo of
+# 5a still left interior differences of up to ~1.1e-5 of the largest
+# coefficient at the largest scale, 6a keeps them below 2e-7 for the scale
+# setups in constants.NAMES (up to ~1.3e-7 for METEOSAT8K / METEOSAT10K).
+HALO_WIDTH = 6
+
+
+def tile_window(shape, a, dx, dy, tile, halo=None):
+    """
+    Halo width and (n, m) shape of the tile windows (tile + halo, at most
+    the image size per axis) of cwt2d_tiled for an image of the given shape
+    and wavelet scales a. halo defaults to HALO_WIDTH times the largest
+    scale.
+    """
+    if halo is None:
+        halo = int(ceil(HALO_WIDTH * a[-1] / min(dx, dy)))
+    return halo, (min(tile + 2 * halo, shape[0]), min(tile + 2 * halo, shape[1]))
+
+
+def cwt2d_tiled(f, dx, dy, dj=1./12, s0=-1, J=-1, wavelet=Mexican_hat(), tile=512, halo=None, n_workers=1,
+                out=None, **kwargs):
+    """
+    Tiled version of cwt2d(rfft=True) for very large domains. The image is
+    split into tile x tile blocks, each block is transformed together with
+    a halo of surrounding pixels and the block interiors are stitched into
+    the output. The FFT work arrays are therefore sized by the tiles
+    instead of the full (padded) domain.
+    All tile windows (block + halo) have the same shape, windows at the
+    image edges are shifted inwards, so that all tiles share one filter
+    bank.
+    Away from the image borders (more than halo pixels), the result matches
+    the full domain transform to within 1e-6 of the largest absolute
+    coefficient of each scale for the default halo (measured below 2e-7,
+    ~1e-5 for a halo of five times the largest scale). Within halo pixels
+    of the image borders, both transforms are affected by the padding and
+    may differ more, so that single pixels of the filtered power masks
+    there can differ from the untiled run.
+    PARAMETERS
+        f, dx, dy, dj, s0, J, wavelet :
+            As in cwt2d.
+        tile (int, optional) :
+            Tile size in pixels (interior, without halo). Default is 512.
+        halo (int, optional) :
+            Halo width in pixels. Default is HALO_WIDTH times the largest
+            wavelet scale in pixels.
+        n_workers (int, optional) :
+            Number of threads transforming tiles in parallel. Default is 1.
+        out (array like, optional) :
+            (J+1) x n x m output array, as in cwt2d.
+        kwargs :
+            Passed on to cwt2d (cache, backend, pad, pad_mode, dtype).
+    RETURNS
+        Wf (array like) :
+            Real wavelet coefficients, (J+1) x n x m.
+    """
+    n0, m0 = f.shape
+    if s0 == -1: s0 = 2 * max(dx,dy) / wavelet.flambda()  # Smallest resolvable scale
+    if J == -1: J = int(log2(max(n0,m0) * max(dx,dy) / s0) / dj)  # Number of scales
+    a = s0 * 2. ** (arange(0, J+1) * dj)
+    halo, (wn, wm) = tile_window((n0, m0), a, dx, dy, tile, halo=halo)
+
+    def window(start, stop, size, width):
+        w0 = min(max(start - halo, 0), size - width)
+        return w0, w0 + width
+
+    tiles = []
+    for y in range(0, n0, tile):
+        for x in range(0, m0, tile):
+            y1, x1 = min(y + tile, n0), min(x + tile, m0)
+            tiles.append(((y, y1, x, x1), window(y, y1, n0, wn) + window(x, x1, m0, wm)))
+
+    Wf = zeros((len(a), n0, m0), dtype=kwargs.get('dtype', 'float64')) if out is None else out
+
+    def run(t):
+        (y, y1, x, x1), (wy, wy1, wx, wx1) = t
+        sub = cwt2d(f[wy:wy1, wx:wx1], dx, dy, dj=dj, s0=s0, J=J, wavelet=wavelet, rfft=True, **kwargs)
+        Wf[:, y:y1, x:x1] = sub[:, y - wy:y1 - wy, x - wx:x1 - wx]
 
-    return Wf[:, :n0, :m0]
+    if n_workers > 1:
+        with ThreadPoolExecutor(max_workers=n_workers) as pool:
+            list(pool.map(run, tiles))
+    else:
+        for t in tiles:
+            run(t)
 
+    return Wf
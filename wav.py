@@ -4,13 +4,20 @@
 """
 import numpy as np
 from ccores import twod as w2d
+from ccores import perfUtils
 import ipdb
 
 
+# products of wavelet.calc_products
+PRODUCTS = ['coeffs', 'raw_power', 'power', 'power_sum']
+
+
 class wavelet(object):
 
 
-    def __init__(self, res, dist, nb, mother2d = w2d.Mexican_hat(), start=None):
+    def __init__(self, res, dist, nb, mother2d = w2d.Mexican_hat(), start=None, fft=None, pad='pow2', pad_mode='constant',
+                 dtype='float64', tile=None, halo=None, tile_workers=1, engine='fft',
+                 profiler=None):
 
         """
         2D continuous wavelet analysis initialisation. This only supports dx == dy.
@@ -21,6 +28,17 @@ class wavelet(object):
         :param start: smallest decomposition scale, smallest resolvable scale is 2*res (== 2*dx)
         :param nb: the number of scales the data is decomposed into
         :param mother2d: a wavelet object, by default Mexican hat
+        :param fft: FFT backend for the transform, a twod.FFTBackend object or backend name ('numpy', 'scipy', 'pyfftw').
+                    Default: twod module default (numpy)
+        :param pad: FFT padding policy, 'pow2' (next power of two, default) or 'fast' (next 5-smooth length)
+        :param pad_mode: fill of the FFT padding, 'constant' (zeros, default), 'reflect' or 'symmetric'
+        :param dtype: working precision of coefficients and power, 'float64' (default) or 'float32'
+        :param tile: if given, calc_coeffs transforms the data in tiles of tile x tile pixels (see twod.cwt2d_tiled)
+        :param halo: tile halo width in pixels, default: twod.HALO_WIDTH times the largest wavelet scale
+        :param tile_workers: number of threads transforming tiles in parallel
+        :param engine: transform engine, 'fft' (default), 'direct' (truncated spatial convolution) or 'auto'
+                       (cheaper of the two per scale), see twod.cwt2d
+        :param profiler: optional perfUtils.profiler, records the transform stages and thresholding
         """
         if start:
             s0 = 2 * start / mother2d.flambda()  # user-defined start scale
@@ -39,46 +57,307 @@ class wavelet(object):
         self.res = res # pixel resolution (e.g. in km)
         self.scales = scales # scales in unit of given pixel resolution
         self.norm_scales = a # wavelet scales for normalising power spectrum
+        self.fft = w2d.get_fft_backend(fft) # FFT backend used by cwt2d
+        self.pad = pad # FFT padding policy
+        self.pad_mode = pad_mode # FFT padding fill
+        self.dtype = np.dtype(dtype) # working precision
+        self.tile = tile # tile size for tiled transforms, None: full domain transform
+        self.halo = halo # tile halo width
+        self.tile_workers = tile_workers # number of threads for tiled transforms
+        self.engine = engine # transform engine per scale: FFT, direct convolution or automatic
+        self.profiler = profiler # optional instrumentation
 
 
 
-    def calc_coeffs(self, data, le_thresh=None, ge_thresh=None, fill=0, normed='scale'):
+    def fft_shape(self, shape):
+        """
+        Padded FFT grid of the transform of an image of the given shape: the grid of the tile windows (tile + halo)
+        for tiled transforms, see twod.tile_window.
+        :param shape: (y, x) image shape
+        :return: (y, x) FFT grid shape
+        """
+        if self.tile:
+            halo, shape = w2d.tile_window(shape, self.norm_scales, self.res, self.res, self.tile, halo=self.halo)
+        return w2d.pad_shape(*shape, pad=self.pad)
+
+
+
+    def calc_coeffs(self, data, le_thresh=None, ge_thresh=None, fill=0, normed='scale', out=None, workspace=None):
         """
         Calculate pos/neg wavelet coefficients and scale-normalised (always positive) wavelet powers
         :param data: 2d array to decompose into scales
         :param le_thresh: less or equal threshold for wavelet coefficients to be filled with fill value
         :param ge_thresh: greater or equal threshold for wavelet coefficients to be filled with fill value
         :param fill:  fill value
+        :param out: optional (wav_coeffs, norm_power) tuple of (scales, y, x) arrays of self.dtype to write the results to
+        :param workspace: optional workspace object providing out and the scratch arrays, so that repeated calls on
+                          same-shaped data don't allocate new cubes. The returned arrays are the workspace buffers
+                          and are overwritten by the next call with the same workspace.
         :return: wav_coeffs: positive and negative wavelet coefficients
                  norm_power: normalised wavelet power spectrum
         """
+        shape = (len(self.scales),) + np.shape(data)
+        if (out is None) and (workspace is not None):
+            out = (_buffer(workspace, 'coeffs', shape, self.dtype), _buffer(workspace, 'power', shape, self.dtype))
+        coeffs_out, power_out = out if out is not None else (None, None)
+
+        wav_coeffs = self._transform(data, out=coeffs_out)
+        norm_power = self._threshold(wav_coeffs, le_thresh=le_thresh, ge_thresh=ge_thresh, fill=fill, normed=normed,
+                                     out=power_out, workspace=workspace)
+        return wav_coeffs, norm_power
+
+
+
+    def calc_products(self, data, products=('coeffs', 'power'), le_thresh=None, ge_thresh=None, fill=0,
+                      normed='scale', workspace=None):
+        """
+        calc_coeffs computing and keeping only the requested products. Cubes that are not requested are never
+        allocated: without 'coeffs', the power is computed in place over the coefficients, and 'power_sum' alone is
+        accumulated scale by scale (see iter_power) without any (scales, y, x) cube.
+        :param data: 2d array to decompose into scales
+        :param products: list of products, any of PRODUCTS:
+                         'coeffs': wavelet coefficients (wav_coeffs of calc_coeffs)
+                         'raw_power': squared wavelet coefficients after thresholding, not normalised
+                         'power': normalised wavelet power (norm_power of calc_coeffs)
+                         'power_sum': 2d normalised wavelet power summed over all scales
+        :param le_thresh, ge_thresh, fill, normed: as in calc_coeffs
+        :param workspace: optional workspace object for the cubes and scratch arrays, see calc_coeffs
+        :return: dictionary product -> array
+        """
+        for product in products:
+            if product not in PRODUCTS:
+                raise ValueError('Product not found. Choose from ' + str(PRODUCTS))
+        kwargs = dict(le_thresh=le_thresh, ge_thresh=ge_thresh, fill=fill)
+        out = {}
+
+        if set(products) == {'power_sum'}:
+            for ids, (coeffs, power) in enumerate(self.iter_power(data, normed=normed, **kwargs)):
+                if ids == 0:
+                    out['power_sum'] = power  # a new array for every scale, can be summed into
+                else:
+                    out['power_sum'] += power
+            return out
+
+        shape = (len(self.scales),) + np.shape(data)
+        wav_coeffs = self._transform(data, out=None if workspace is None else _buffer(workspace, 'coeffs', shape,
+                                                                                       self.dtype))
+
+        # power cubes to compute, the last one overwrites the coefficients if these are not kept
+        cubes = [name for name in ['raw_power', 'power'] if (name in products) or
+                 ((name == 'power') and ('power_sum' in products))]
+        for ids, name in enumerate(cubes):
+            in_place = (ids == len(cubes) - 1) and ('coeffs' not in products)
+            target = wav_coeffs if in_place else _buffer(workspace, name, shape, self.dtype)
+            out[name] = self._threshold(wav_coeffs, normed=normed if name == 'power' else None, out=target,
+                                        workspace=workspace, **kwargs)
+
+        if 'coeffs' in products:
+            out['coeffs'] = wav_coeffs
+        if 'power_sum' in products:
+            out['power_sum'] = np.add.reduce(out['power'], axis=0)  # scales summed in order, as powerUtils._sum_scales
+            if 'power' not in products:
+                del out['power']
+        return out
+
+
+
+    def _transform(self, data, out=None):
+        """
+        Real wavelet coefficients (scales, y, x) of data, full domain or tiled.
+        """
+        # the Mexican hat is real and symmetric: real-to-real transform, real coefficients
+        if self.tile:
+            return w2d.cwt2d_tiled(data, self.res, self.res, dj=self.scale_dist, s0=self.scale_start,
+                                   J=self.scale_number, tile=self.tile, halo=self.halo,
+                                   n_workers=self.tile_workers, backend=self.fft, pad=self.pad,
+                                   pad_mode=self.pad_mode, dtype=self.dtype, engine=self.engine,
+                                   profiler=self.profiler, out=out)
+        return w2d.cwt2d(data, self.res, self.res, dj=self.scale_dist, s0=self.scale_start, J=self.scale_number,
+                         rfft=True, backend=self.fft, pad=self.pad, pad_mode=self.pad_mode,
+                         dtype=self.dtype, engine=self.engine, profiler=self.profiler, out=out)
+
+
+
+    def calc_coeffs_batch(self, data, le_thresh=None, ge_thresh=None, fill=0, normed='scale', batch_size=None,
+                          workspace=None):
+        """
+        calc_coeffs for a stack of images on the same grid (e.g. time slots), transformed together in batches with
+        twod.cwt2d_batch. Falls back to calc_coeffs image by image for the tiled transform.
+        :param data: 3d array (images, y, x)
+        :param le_thresh, ge_thresh, fill, normed: as in calc_coeffs, applied to every image
+        :param batch_size: number of images per batched FFT (default: all images of data)
+        :param workspace: optional workspace object for the (images, scales, y, x) cubes and the scratch arrays, see
+                          calc_coeffs
+        :return: wav_coeffs, norm_power: (images, scales, y, x) arrays, [i] as returned by calc_coeffs(data[i])
+        """
+        kwargs = dict(le_thresh=le_thresh, ge_thresh=ge_thresh, fill=fill, normed=normed)
+        shape = (len(data), len(self.scales)) + np.shape(data)[1:]
+        wav_coeffs = _buffer(workspace, 'batch_coeffs', shape, self.dtype)
+        norm_power = _buffer(workspace, 'batch_power', shape, self.dtype)
+        if self.tile:
+            for ids, img in enumerate(data):
+                self.calc_coeffs(img, out=(wav_coeffs[ids], norm_power[ids]), workspace=workspace, **kwargs)
+            return wav_coeffs, norm_power
+
+        w2d.cwt2d_batch(data, self.res, self.res, dj=self.scale_dist, s0=self.scale_start, J=self.scale_number,
+                        rfft=True, backend=self.fft, pad=self.pad, pad_mode=self.pad_mode, dtype=self.dtype,
+                        engine=self.engine, batch_size=batch_size or len(data), profiler=self.profiler,
+                        out=wav_coeffs)
+
+        ws = _scratch(workspace)  # scratch arrays shared by all images
+        for ids in range(wav_coeffs.shape[0]):
+            self._threshold(wav_coeffs[ids], out=norm_power[ids], workspace=ws, **kwargs)
+        return wav_coeffs, norm_power
+
+
+
+    def _threshold(self, wav_coeffs, le_thresh=None, ge_thresh=None, fill=0, normed='scale', out=None,
+                   workspace=None):
+        """
+        Normalised wavelet power of calc_coeffs for a (scales, y, x) coefficient cube in a single in-place pass over
+        out: squared coefficients, fill**2 where coefficients are thresholded, normalised by scale or standard
+        deviation (no normalisation for other values of normed). wav_coeffs is not modified unless it is out.
+        :param out: optional output array (default: new array), can be wav_coeffs
+        :param workspace: optional workspace for the scratch arrays
+        :return: norm_power: normalised wavelet power spectrum
+        """
+        with perfUtils.stage(self.profiler, 'threshold', nbytes=wav_coeffs.nbytes, shape=wav_coeffs.shape):
+            # thresholded coefficients, before the coefficients may be overwritten by out
+            mask = None
+            for thresh, compare in [(le_thresh, np.less_equal), (ge_thresh, np.greater_equal)]:
+                if thresh is None:
+                    continue
+                if mask is None:
+                    mask = compare(wav_coeffs, thresh, out=_buffer(workspace, 'mask', wav_coeffs.shape, bool))
+                else:
+                    np.logical_or(mask, compare(wav_coeffs, thresh, out=_buffer(workspace, 'mask2', wav_coeffs.shape,
+                                                                                 bool)), out=mask)
+
+            norm_power = np.empty_like(wav_coeffs) if out is None else out
+            np.multiply(wav_coeffs, wav_coeffs, out=norm_power)  # squared wavelet coefficients
+            if mask is not None:
+                fill = wav_coeffs.dtype.type(fill)
+                np.copyto(norm_power, fill * fill, where=mask)
+
+            if normed == 'scale':
+                scale_dummy = np.reshape(self.norm_scales, (len(self.norm_scales), 1, 1)).astype(self.dtype)
+                np.divide(norm_power, scale_dummy * scale_dummy, out=norm_power) # Normalized wavelet power spectrum
+                # Note: Liu et al 2007 JOAT suggest dividing by wavelet scale only - we emphasize small scales more.
+            if normed == 'stddev':
+                tmp = _buffer(workspace, 'scale', wav_coeffs.shape[1:], norm_power.dtype)
+                for ids in range(norm_power.shape[0]):
+                    norm_power[ids] /= std(norm_power[ids], tmp)
+
+        return norm_power
+
+
+
+    def iter_power(self, data, le_thresh=None, ge_thresh=None, fill=0, normed='scale', cache=False):
+        """
+        Streaming version of calc_coeffs: calculates wavelet coefficients and normalised power one scale at a time,
+        so that only a few 2d arrays are held in memory at any time instead of the full (scales, y, x) cubes.
+        :param data: 2d array to decompose into scales
+        :param le_thresh: less or equal threshold for wavelet coefficients to be filled with fill value
+        :param ge_thresh: greater or equal threshold for wavelet coefficients to be filled with fill value
+        :param fill:  fill value
+        :param normed: power normalisation, 'scale' or 'stddev' as in calc_coeffs
+        :param cache: if True, takes the spectral kernels from the (memory intensive) filter bank cache instead of
+                      building them scale by scale
+        :return: generator of (wav_coeffs, norm_power) 2d arrays per scale, from smallest to largest scale
+        """
+
+        scales = w2d.cwt2d_iter(data, self.res, self.res, dj=self.scale_dist, s0=self.scale_start,
+                                J=self.scale_number, cache=cache, backend=self.fft, pad=self.pad,
+                                pad_mode=self.pad_mode, dtype=self.dtype, engine=self.engine, profiler=self.profiler)
+
+        for ids, wav_coeffs_pure in enumerate(scales):
+
+            with perfUtils.stage(self.profiler, 'threshold', scale=ids, nbytes=wav_coeffs_pure.nbytes):
+                wav_coeffs = wav_coeffs_pure.copy()
+                if le_thresh != None:
+                    wav_coeffs[wav_coeffs <= le_thresh] = fill
+
+                if ge_thresh != None:
+                    wav_coeffs[wav_coeffs >= ge_thresh] = fill
+
+                norm_power = (np.abs(wav_coeffs)) * (np.abs(wav_coeffs))  # squared wavelet coefficients
+                if normed == 'scale':
+                    norm_power = norm_power / self.dtype.type(self.norm_scales[ids] * self.norm_scales[ids])
+                if normed == 'stddev':
+                    norm_power = norm_power / np.std(norm_power)
+
+            yield wav_coeffs_pure, norm_power
+
+
+
+class workspace(object):
+
+    def __init__(self):
+        """
+        Reusable arrays for calc_coeffs (coefficient and power cubes, threshold masks, scratch planes). Arrays are
+        allocated on first use and kept as long as they are requested with the same shape and dtype, e.g. for a time
+        series of images on the same grid (see cores.dataset.applyWavelet(workspace=...)).
+        """
+        self.buffers = {}
+
+
+
+    def get(self, name, shape, dtype):
+        """
+        Returns the array called name, (re-)allocated if shape or dtype changed. Contents are undefined.
+        """
+        arr = self.buffers.get(name)
+        if (arr is None) or (arr.shape != tuple(shape)) or (arr.dtype != np.dtype(dtype)):
+            arr = np.empty(shape, dtype=dtype)
+            self.buffers[name] = arr
+        return arr
+
+
+
+    @property
+    def nbytes(self):
+        return sum(arr.nbytes for arr in self.buffers.values())
+
+
+
+    def clear(self):
+        """
+        Releases all arrays.
+        """
+        self.buffers = {}
 
-        wav_coeffs = w2d.cwt2d(data, self.res, self.res, dj=self.scale_dist, s0=self.scale_start, J=self.scale_number)
 
 
-        wav_coeffs_pure = np.real(wav_coeffs.copy())
-        if le_thresh!=None:
-            wav_coeffs[np.real(wav_coeffs <= le_thresh)] = fill
+def _scratch(ws):
+    """
+    Workspace ws, or a new workspace for scratch arrays shared by several calls.
+    """
+    return ws if ws is not None else workspace()
 
-        if ge_thresh!=None:
-            wav_coeffs[np.real(wav_coeffs >= ge_thresh)] = fill
 
 
-        norm_power = (np.abs(wav_coeffs)) * (np.abs(wav_coeffs))  # squared wavelet coefficients
-        scale_dummy = np.reshape(self.norm_scales, (len(self.norm_scales), 1, 1))
-        if normed == 'scale':
-            norm_power = norm_power / (scale_dummy * scale_dummy) # Normalized wavelet power spectrum
-            # Note: Liu et al 2007 JOAT suggest dividing by wavelet scale only - we emphasize small scales more.
-        if normed == 'stddev':
+def _buffer(ws, name, shape, dtype):
+    """
+    Array name of workspace ws, a new array without workspace.
+    """
+    if ws is None:
+        return np.empty(shape, dtype=dtype)
+    return ws.get(name, shape, dtype)
 
-            for ids in range(norm_power.shape[0]):
-                arr = norm_power[ids,:,:]
-                out = arr / np.std(arr)
-                norm_power[ids,:,:] = out
 
-            for ids in range(wav_coeffs.shape[0]):
-                arr = wav_coeffs[ids,:,:]
-                out = arr / np.std(arr)
-                wav_coeffs[ids,:,:] = out
 
-        return wav_coeffs_pure, norm_power
+def std(arr, tmp=None):
+    """
+    np.std(arr) of a contiguous 2d array computed with the scratch array tmp (same shape and dtype) instead of new
+    temporaries. Follows the numpy implementation step by step, so that results are identical to np.std.
+    """
+    if tmp is None:
+        return np.std(arr)
+    n = np.intp(arr.size)
+    mean = np.add.reduce(arr, axis=None, keepdims=True)
+    np.true_divide(mean, n, out=mean, casting='unsafe')
+    np.subtract(arr, mean, out=tmp)
+    np.multiply(tmp, tmp, out=tmp)
+    var = np.add.reduce(tmp, axis=None)
+    var = var.dtype.type(var / n)
+    return var.dtype.type(np.sqrt(var))